@@ -0,0 +1,99 @@
+# LLM 呼叫層 (llm_gateway.py) 的本機壓測
+# 在背景啟動 mock_gemini_server.py，以固定亂數種子重現幾種情境，比較延遲分佈與額外呼叫數：
+#   fallback : 第一個模型故障 (全部回 503)，觀察回退與斷路器 (冷卻時間長於整個壓測，開啟後不再打第一個模型)
+#   hedging  : 第一個模型 5% 請求特別慢，比較 hedge 開 / 關的 p95 / p99
+#   ratelimit: 突發請求遠超過本機 RPM 額度 (初始額度 = RPM)，觀察排隊與改用下一個模型
+# 每個變體另外列出斷路器略過、額度不足改用下一個模型、額度排隊的次數
+# 執行方式: python3 bench_gateway.py [每個情境的請求數] (需已安裝 google-genai，不需要 API Key)
+import asyncio
+import contextlib
+import io
+import sys
+
+from llm_gateway import LLMGateway
+from model_health import ModelHealth
+from rate_limiter import ModelRateLimiter
+from mock_gemini_server import start_in_background
+
+MODELS = ["primary-model", "backup-model"]
+
+SCENARIOS = {
+    "fallback": {
+        "models": {
+            "primary-model": {"latency": {"dist": "fixed", "seconds": 0.2}, "errors": {"503": 1.0}},
+            "default": {"latency": {"dist": "fixed", "seconds": 0.3}},
+        },
+    },
+    "hedging": {
+        "models": {
+            "primary-model": {"latency": {"dist": "bimodal", "fast": 0.2, "slow": 3.0, "slow_ratio": 0.05}},
+            "default": {"latency": {"dist": "lognormal", "median": 0.3, "sigma": 0.2}},
+        },
+    },
+    "ratelimit": {
+        "models": {"default": {"latency": {"dist": "fixed", "seconds": 0.1}}},
+    },
+}
+
+
+# 由逐次呼叫的 log 統計的事件 (名稱, log 中的字樣)
+EVENTS = [
+    ("斷路器略過", "略過暫時不可用的模型"),
+    ("額度不足改用下一個模型", "本機速率限制額度不足"),
+    ("額度排隊", "額度排隊"),
+]
+
+
+VARIANTS = {
+    # 情境 -> [(名稱, LLMGateway 參數, generate 參數), ...]
+    "fallback": [
+        ("無斷路器", {}, {}),
+        ("斷路器", {"health": lambda: ModelHealth(None, failure_threshold=2, cooldown_seconds=600)}, {}),
+    ],
+    "hedging": [
+        ("hedge 關", {}, {}),
+        ("hedge 開", {"hedge_default_delay": 0.5, "hedge_min_samples": 10**9}, {"hedge": True}),
+    ],
+    "ratelimit": [
+        ("不限制", {}, {}),
+        ("RPM 10", {"limiter": lambda: ModelRateLimiter({"primary-model": {"rpm": 10}}), "max_queue_wait": 0.5}, {}),
+    ],
+}
+
+
+async def run(base_url, count, concurrency, gateway_options, generate_options):
+    options = {k: v() if callable(v) else v for k, v in gateway_options.items()}
+    llm = LLMGateway("mock-key", timeout=10, retries=0, base_url=base_url, **options)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            return await llm.generate(MODELS, f"第 {i} 則測試訊息", **generate_options)
+
+    # 逐次呼叫的 log 太多，壓測時不顯示 (只用來統計事件次數)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        results = await asyncio.gather(*(one(i) for i in range(count)))
+        await llm.aclose()
+    used = {}
+    for result in results:
+        used[result.model] = used.get(result.model, 0) + 1
+    events = {name: log.getvalue().count(marker) for name, marker in EVENTS}
+    return llm, used, events
+
+
+async def main(count):
+    for name, config in SCENARIOS.items():
+        print(f"\n=== {name} ===")
+        for label, gateway_options, generate_options in VARIANTS[name]:
+            server, state, base_url = start_in_background(config, seed=42)
+            llm, used, events = await run(base_url, count, 8, gateway_options, generate_options)
+            server.shutdown()
+            api_calls = sum(stats["requests"] for stats in state.stats.values())
+            print(f"{label:<8} {llm.latency_report()}")
+            print(f"{'':<8} 使用模型: {used}，API 呼叫 {api_calls} 次 (含錯誤): {state.stats}")
+            print(f"{'':<8} " + "，".join(f"{name} {n} 次" for name, n in events.items()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
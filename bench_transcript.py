@@ -0,0 +1,114 @@
+# 訊息清理模組 (transcript.py) 的微基準測試
+# 以 50k 則合成訊息比較「舊版逐則 re.sub」與共用模組的處理速度 (messages/sec)
+# 執行方式: python3 bench_transcript.py [訊息數]
+import re
+import sys
+import time
+import random
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+from transcript import normalize_message, format_line, build_time_format
+
+SETTINGS = {
+    "AUTHOR_NAME_LIMIT": 4,
+    "MAX_MSG_LENGTH": 500,
+    "SHOW_DATE": False,
+    "SHOW_SECONDS": False,
+    "SHOW_ATTACHMENTS": False,
+    "SIMPLIFY_LINKS": True,
+    "IGNORE_TOKEN": "-# 🤖",
+    "BOT_NAME": "機器人",
+    "TZ": timezone(timedelta(hours=8)),
+}
+BOT_ID = 1
+
+SAMPLES = [
+    "今天晚上要不要一起打球？",
+    "看這個 https://www.youtube.com/watch?v=dQw4w9WgXcQ 超好笑 <:lol:123456789012345678>",
+    "<@{uid}> 你明天幾點到？ <a:wave:223456789012345678>",
+    "好喔 <@!{uid}> <@{uid2}> 我們 8 點在 https://maps.app.goo.gl/abc123 集合",
+    "summary text -# 🤖 以上重點摘要由 AI 產生",
+    "lol " * 40,
+    "",
+]
+
+
+def make_corpus(count):
+    rng = random.Random(42)
+    users = [SimpleNamespace(id=1000 + i, name=f"user{i}", display_name=f"使用者{i}號") for i in range(50)]
+    channel = SimpleNamespace(id=42)
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    corpus = []
+    for i in range(count):
+        author = rng.choice(users)
+        mentioned = rng.sample(users, 2)
+        content = rng.choice(SAMPLES).format(uid=mentioned[0].id, uid2=mentioned[1].id)
+        corpus.append(SimpleNamespace(
+            id=i, channel=channel, author=author, content=content,
+            created_at=start + timedelta(seconds=i * 7),
+            mentions=mentioned if "<@" in content else [],
+            message_snapshots=[], embeds=[],
+            attachments=[SimpleNamespace(url="https://cdn/x.png")] if not content else [],
+        ))
+    return corpus
+
+
+def legacy_normalize(msg, settings, time_fmt):
+    """舊版 server.py 迴圈內的清理邏輯 (每則訊息重新定義 replacer 並呼叫未編譯的 re.sub)"""
+    content = msg.content
+    is_bot_msg = False
+    if settings["IGNORE_TOKEN"] in content:
+        content = content.split(settings["IGNORE_TOKEN"])[0]
+        is_bot_msg = True
+    if msg.author.id == BOT_ID:
+        is_bot_msg = True
+    if msg.mentions:
+        for user in msg.mentions:
+            u_name = user.display_name[:settings["AUTHOR_NAME_LIMIT"]]
+            content = content.replace(f"<@{user.id}>", f"@{u_name}")
+            content = content.replace(f"<@!{user.id}>", f"@{u_name}")
+    if settings["SIMPLIFY_LINKS"]:
+        def domain_replacer(match):
+            url = match.group(0)
+            try:
+                no_proto = url.split("://", 1)[1]
+                return f"(連結 {no_proto.split('/', 1)[0]})"
+            except: return url
+        content = re.sub(r'https?://\S+', domain_replacer, content)
+    content = re.sub(r'<a?:\w+:\d+>', '(貼圖)', content)
+    if len(content) > settings["MAX_MSG_LENGTH"]:
+        content = content[:settings["MAX_MSG_LENGTH"]] + "..."
+    created_at_local = msg.created_at.astimezone(settings["TZ"]).strftime(time_fmt)
+    author_name = settings["BOT_NAME"] if is_bot_msg else msg.author.display_name[:settings["AUTHOR_NAME_LIMIT"]]
+    if not content.strip() and not msg.attachments:
+        return None
+    line = f"{author_name}@{created_at_local}: {content}"
+    if msg.attachments:
+        line += " (附件)"
+    return line
+
+
+def shared_normalize(msg, settings, time_fmt):
+    record = normalize_message(msg, BOT_ID, settings)
+    return format_line(record, settings, time_fmt) if record else None
+
+
+def bench(name, func, corpus, time_fmt, repeat=3):
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = [func(msg, SETTINGS, time_fmt) for msg in corpus]
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"{name:<8} {len(corpus) / elapsed:>12,.0f} msgs/sec  ({elapsed:.3f}s)")
+    return lines
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    corpus = make_corpus(count)
+    time_fmt = build_time_format(SETTINGS)
+    print(f"合成訊息數: {count:,}")
+    legacy_lines = bench("legacy", legacy_normalize, corpus, time_fmt)
+    shared_lines = bench("shared", shared_normalize, corpus, time_fmt)
+    print("輸出一致" if legacy_lines == shared_lines else "⚠️ 輸出不一致")
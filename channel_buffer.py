@@ -0,0 +1,150 @@
+# channel_buffer.py
+# 每個頻道在記憶體中保留最近 maxlen 則訊息 (ring buffer)，供 tagged_reply 組合對話歷史時直接讀取，
+# 省去每次被提及都要呼叫 channel.history() 的 REST 往返
+#
+# - 頻道第一次使用時才以 history() 暖機，之後由 on_message / 編輯 / 刪除事件持續更新
+# - 未暖機的頻道不記錄事件 (暖機時會從 history() 取得)
+# - 緩衝區無法完整回答的請求 (例如超過 maxlen、被回覆的訊息太舊) 改用 history() 直接抓取
+# - 重新連線 (on_ready) 時可能漏掉事件，呼叫 clear() 讓所有頻道重新暖機
+
+from collections import OrderedDict
+
+from singleflight import SingleFlight
+
+
+class ChannelBuffer:
+    """單一頻道的訊息緩衝 (依訊息 ID 排序，snowflake ID 即時間順序)"""
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.messages = OrderedDict()  # message_id -> discord.Message (舊 -> 新)
+        self.reached_start = False     # 暖機時已抓到頻道最開頭 (緩衝區之前沒有更舊的訊息)
+        self.warming = True
+        self.deleted = set()           # 暖機期間刪除的訊息 ID (避免被 history() 的結果加回來)
+
+    def add(self, message):
+        last_id = next(reversed(self.messages), None)
+        self.messages[message.id] = message
+        if last_id is not None and message.id < last_id:
+            # 亂序到達 (少見)：依 ID 重新排序
+            self.messages = OrderedDict(sorted(self.messages.items()))
+        while len(self.messages) > self.maxlen:
+            self.messages.popitem(last=False)
+            self.reached_start = False
+
+    def merge_history(self, messages, limit):
+        """合併暖機時 history() 抓到的訊息 (新 -> 舊)"""
+        for message in messages:
+            if message.id not in self.deleted and message.id not in self.messages:
+                self.messages[message.id] = message
+        self.messages = OrderedDict(sorted(self.messages.items()))
+        self.reached_start = len(messages) < limit
+        while len(self.messages) > self.maxlen:
+            # 暖機期間新到的訊息把最舊的擠出去：緩衝區的開頭已不是頻道開頭
+            self.messages.popitem(last=False)
+            self.reached_start = False
+        self.warming = False
+        self.deleted.clear()
+
+
+class MessageBuffer:
+    def __init__(self, maxlen=200):
+        self.maxlen = maxlen  # 0 = 停用，一律使用 history()
+        self.channels = {}  # channel_id -> ChannelBuffer
+        self.warmups = SingleFlight()  # 同一頻道同時只暖機一次
+        self.stats = {"hits": 0, "fetches": 0}
+
+    # ---- 事件更新 ----
+
+    def add(self, message):
+        """新訊息 (on_message，包含 Bot 自己的訊息)"""
+        buffer = self.channels.get(message.channel.id)
+        if buffer is not None:
+            buffer.add(message)
+
+    def replace(self, message):
+        """訊息被編輯：若在緩衝區內則換成新內容"""
+        buffer = self.channels.get(message.channel.id)
+        if buffer is not None and message.id in buffer.messages:
+            buffer.messages[message.id] = message
+
+    def contains(self, channel_id, message_id):
+        buffer = self.channels.get(channel_id)
+        return buffer is not None and message_id in buffer.messages
+
+    def get(self, channel_id, message_id):
+        """緩衝區內的訊息 (沒有則回傳 None)"""
+        buffer = self.channels.get(channel_id)
+        return buffer.messages.get(message_id) if buffer is not None else None
+
+    def remove(self, channel_id, message_ids):
+        """訊息被刪除 (單則或批次)"""
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            return
+        for message_id in message_ids:
+            buffer.messages.pop(message_id, None)
+            if buffer.warming:
+                buffer.deleted.add(message_id)
+
+    def refresh_member(self, member):
+        """
+        成員改暱稱：緩衝區內的訊息保存的是當時的 Member 物件 (不會自動更新)，
+        換成最新的 Member，讓之後整理出的名稱與即時抓取的 history() 一致
+        """
+        for buffer in self.channels.values():
+            for message in buffer.messages.values():
+                if getattr(message, "guild", None) != member.guild:
+                    break  # 同一頻道的訊息都屬於同一伺服器
+                if message.author.id == member.id:
+                    message.author = member
+                if any(user.id == member.id for user in message.mentions):
+                    message.mentions = [member if user.id == member.id else user for user in message.mentions]
+
+    def clear(self):
+        self.channels.clear()
+
+    # ---- 讀取 ----
+
+    async def _warm(self, channel):
+        buffer = ChannelBuffer(self.maxlen)
+        self.channels[channel.id] = buffer
+        try:
+            messages = [m async for m in channel.history(limit=self.maxlen)]
+        except Exception:
+            self.channels.pop(channel.id, None)
+            raise
+        buffer.merge_history(messages, self.maxlen)
+        print(f"   🧺 頻道 #{channel} 訊息緩衝暖機完成 ({len(buffer.messages)} 則)")
+
+    async def _ready(self, channel):
+        """回傳已暖機的 ChannelBuffer (必要時先暖機)"""
+        buffer = self.channels.get(channel.id)
+        if buffer is None or buffer.warming:
+            await self.warmups.do(channel.id, lambda: self._warm(channel))
+            buffer = self.channels.get(channel.id)
+        return buffer
+
+    async def latest(self, channel, limit):
+        """最新 limit 則訊息 (新 -> 舊，同 channel.history(limit=limit))"""
+        if 0 < limit <= self.maxlen:
+            buffer = await self._ready(channel)
+            if buffer is not None and (len(buffer.messages) >= limit or buffer.reached_start):
+                self.stats["hits"] += 1
+                return list(reversed(buffer.messages.values()))[:limit]
+        self.stats["fetches"] += 1
+        return [m async for m in channel.history(limit=limit)]
+
+    async def around(self, channel, center, limit):
+        """以 center 為中心前後共 limit 則訊息 (同 channel.history(around=center, limit=limit))"""
+        if 0 < limit <= self.maxlen:
+            buffer = await self._ready(channel)
+            if buffer is not None and center.id in buffer.messages:
+                ids = list(buffer.messages)
+                start = ids.index(center.id) - limit // 2
+                if start >= 0 or buffer.reached_start:
+                    self.stats["hits"] += 1
+                    window = [buffer.messages[i] for i in ids[max(start, 0):max(start, 0) + limit]]
+                    return list(reversed(window))
+        self.stats["fetches"] += 1
+        return [m async for m in channel.history(around=center, limit=limit)]
@@ -0,0 +1,160 @@
+# context_cache.py
+# 明確的 Context Caching：把 Prompt 中穩定的前綴 (人設規則 + 較舊的對話歷史) 建成 Gemini cached content，
+# 同一頻道接下來的提問只需送出「快取之後新增的訊息 + 當前任務」，降低輸入成本與首字延遲
+#
+# 前綴以「段落 list」表示 (例如 [人設, 歷史第 1 則, 歷史第 2 則, ...])：
+# - 對話歷史是「最新 N 則」的滑動視窗，每次提問最舊的幾則會滑出；
+#   只要人設相同、目前的歷史從快取中的某一則開始並一路對齊到快取結尾，就沿用快取，
+#   只送出快取結尾之後的段落 (快取開頭已滑出視窗的少數舊訊息會留在快取中，
+#   這些舊訊息也算進輸入預算：呼叫端以 max_stale_tokens 指定還能容納多少)
+# - 無法沿用 (人設變更、對不上、滑出太多) 或快取後累積太多新內容 -> 在背景建立新的快取，下次提問生效
+# 建立 / 延長 / 刪除快取都在背景執行，不增加提問的等待時間
+
+import asyncio
+import hashlib
+import time
+
+from google.genai import types
+
+from transcript import estimate_tokens
+
+
+def _digest(parts):
+    return [hashlib.sha256(p.encode("utf-8")).digest() for p in parts]
+
+
+class ContextCacheRegistry:
+    def __init__(self, client, ttl_seconds=600, min_tokens=2048, unsupported_prefixes=("gemma",),
+                 max_stale_ratio=0.5, delete_grace_seconds=120):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens  # 低於此估計值不建立快取 (API 有最小 token 數限制)
+        self.unsupported_prefixes = unsupported_prefixes
+        self.max_stale_ratio = max_stale_ratio  # 快取歷史中最多幾成可以是已滑出視窗的舊訊息
+        self.delete_grace_seconds = delete_grace_seconds  # 被取代的舊快取延後刪除 (進行中的請求可能還在使用)
+        self.entries = {}  # key -> {"name", "digests", "tokens" (各段估計 token 數), "expires"}
+        self.failed_until = {}  # model -> 建立失敗後暫停嘗試到何時
+        self.pending = {}  # key -> 背景工作 (同一 key 同時只有一個)
+        self.deleting = set()  # 延後刪除舊快取的工作 (不佔用 pending，之後的重建 / 延長不必等待)
+
+    def supports(self, model_name):
+        if model_name.startswith(self.unsupported_prefixes):
+            return False
+        return self.failed_until.get(model_name, 0) <= time.time()
+
+    def _spawn(self, key, make_coro):
+        """在背景執行 make_coro()；同一 key 已有背景工作進行中則略過"""
+        task = self.pending.get(key)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(make_coro())
+        self.pending[key] = task
+
+        def forget(done):
+            if self.pending.get(key) is done:
+                del self.pending[key]
+        task.add_done_callback(forget)
+
+    async def _create(self, model_name, parts):
+        cache = await self.client.aio.caches.create(
+            model=model_name,
+            config=types.CreateCachedContentConfig(
+                contents=["\n".join(parts)],
+                ttl=f"{self.ttl_seconds}s",
+            ),
+        )
+        return cache.name
+
+    async def _delete_later(self, entry):
+        await asyncio.sleep(self.delete_grace_seconds)
+        try:
+            await self.client.aio.caches.delete(name=entry["name"])
+        except Exception as e:
+            print(f"   ⚠️ 刪除舊的 Context Cache 失敗 (會自行過期): {e}")
+
+    async def _rebuild(self, key, model_name, parts, digests):
+        """背景建立新的快取，成功後取代舊的 (舊快取延後刪除)"""
+        try:
+            name = await self._create(model_name, parts)
+        except Exception as e:
+            print(f"   ⚠️ 模型 {model_name} 建立 Context Cache 失敗，{self.ttl_seconds}s 內不再嘗試: {e}")
+            self.failed_until[model_name] = time.time() + self.ttl_seconds
+            return
+        old = self.entries.get(key)
+        self.entries[key] = {
+            "name": name,
+            "digests": digests,
+            "tokens": [estimate_tokens(p) for p in parts],
+            "expires": time.time() + self.ttl_seconds,
+        }
+        print(f"   🧊 已建立 Context Cache ({len(parts)} 段，TTL {self.ttl_seconds}s)")
+        if old:
+            task = asyncio.create_task(self._delete_later(old))
+            self.deleting.add(task)
+            task.add_done_callback(self.deleting.discard)
+
+    async def _refresh(self, entry):
+        """延長快取存活時間，失敗則讓它自然過期 (之後會重建)"""
+        try:
+            await self.client.aio.caches.update(
+                name=entry["name"], config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except Exception as e:
+            print(f"   ⚠️ Context Cache 延長失敗: {e}")
+            return
+        entry["expires"] = time.time() + self.ttl_seconds
+
+    def _covered(self, entry, digests, max_stale_tokens):
+        """
+        回傳 (目前的段落中有幾段已包含在快取內, 已滑出視窗的舊訊息數)；(0, 0) = 無法沿用
+        條件：人設 (第 0 段) 相同，且目前的歷史從快取歷史的第 start 則開始、一路對齊到快取結尾
+        start 即已滑出視窗的舊訊息數，不可超過 max_stale_ratio，其 token 數不可超過 max_stale_tokens
+        """
+        cached_digests = entry["digests"]
+        if not digests or digests[0] != cached_digests[0]:
+            return 0, 0
+        cached_lines = cached_digests[1:]
+        lines = digests[1:]
+        max_stale = int(len(cached_lines) * self.max_stale_ratio)
+        stale_tokens = 0
+        for start in range(min(max_stale, max(len(cached_lines) - 1, 0)) + 1):
+            if start:
+                stale_tokens += entry["tokens"][start]
+                if max_stale_tokens is not None and stale_tokens > max_stale_tokens:
+                    break
+            overlap = cached_lines[start:]
+            if lines[:len(overlap)] == overlap:
+                return 1 + len(overlap), start
+        return 0, 0
+
+    async def acquire(self, key, model_name, parts, max_stale_tokens=None):
+        """
+        回傳 (cache_name, 已快取的段落數, 快取中已滑出視窗的舊訊息數)；不使用快取時回傳 (None, 0, 0)
+        key: 快取的歸屬 (例如 (頻道 ID, 模型, 模式))，同一 key 只保留一份快取
+        max_stale_tokens: 輸入預算還能容納多少舊訊息 (None = 不限)
+        不會等待任何 API 呼叫：需要建立 / 延長快取時在背景進行
+        """
+        if not self.supports(model_name):
+            return None, 0, 0
+
+        digests = _digest(parts)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry["expires"] - now < 60:
+            # 即將過期：這次不使用 (避免生成途中過期)
+            self.entries.pop(key)
+            entry = None
+
+        covered, stale = self._covered(entry, digests, max_stale_tokens) if entry else (0, 0)
+        if covered:
+            if estimate_tokens("\n".join(parts[covered:])) >= self.min_tokens:
+                # 快取之後累積了不少新內容：這次照常沿用，背景重建成更長的前綴
+                self._spawn(key, lambda: self._rebuild(key, model_name, parts, digests))
+            elif entry["expires"] - now < self.ttl_seconds / 2:
+                self._spawn(key, lambda: self._refresh(entry))
+            print(f"   🧊 沿用 Context Cache ({covered}/{len(parts)} 段，含已滑出視窗的舊訊息 {stale} 則)")
+            return entry["name"], covered, stale
+
+        if estimate_tokens("\n".join(parts)) >= self.min_tokens:
+            print("   🧊 背景建立 Context Cache (下次提問生效)")
+            self._spawn(key, lambda: self._rebuild(key, model_name, parts, digests))
+        return None, 0, 0
@@ -0,0 +1,95 @@
+# fetch_planner.py
+# 共用歷史掃描：把各排程任務需要的時間窗取聯集，每個頻道只向 Discord 掃描一次，
+# 再讓各任務從記憶體中依自己的時間窗過濾出需要的訊息
+
+import discord
+
+from message_store import snowflake_from_datetime
+from history_fetcher import gather_channels
+
+
+def _to_snowflake(point):
+    """datetime / discord.Object / int 統一轉成 snowflake 以便比較"""
+    if point is None:
+        return None
+    if isinstance(point, int):
+        return point
+    if hasattr(point, "id"):
+        return point.id
+    return snowflake_from_datetime(point)
+
+
+def plan_windows(requests):
+    """
+    requests: [(channel_id, after, before), ...] (before=None 代表到現在)
+    回傳 {channel_id: (after_id, before_id)}，同一頻道的多個時間窗取聯集 (最早起點 ~ 最晚終點)
+    """
+    windows = {}
+    for channel_id, after, before in requests:
+        after_id, before_id = _to_snowflake(after), _to_snowflake(before)
+        if channel_id not in windows:
+            windows[channel_id] = (after_id, before_id)
+            continue
+        old_after, old_before = windows[channel_id]
+        merged_before = None if old_before is None or before_id is None else max(old_before, before_id)
+        windows[channel_id] = (min(old_after, after_id), merged_before)
+    return windows
+
+
+class HistorySnapshot:
+    """一次掃描的結果 (channel_id -> 依時間排序的訊息)，提供依時間窗過濾的檢視"""
+
+    def __init__(self, windows, messages):
+        self.windows = windows
+        self.messages = messages
+
+    def covers(self, channel_id, after, before=None):
+        """此快照是否完整涵蓋所要求的時間窗"""
+        if channel_id not in self.messages:
+            return False
+        win_after, win_before = self.windows[channel_id]
+        after_id, before_id = _to_snowflake(after), _to_snowflake(before)
+        if after_id < win_after:
+            return False
+        if win_before is not None and (before_id is None or before_id > win_before):
+            return False
+        return True
+
+    def view(self, channel_id, after, before=None):
+        after_id, before_id = _to_snowflake(after), _to_snowflake(before)
+        return [
+            msg for msg in self.messages[channel_id]
+            if msg.id > after_id and (before_id is None or msg.id < before_id)
+        ]
+
+
+async def scan_shared_history(client, requests, concurrency=4):
+    """依 plan_windows 的結果並行掃描所有頻道一次，回傳 HistorySnapshot"""
+    windows = plan_windows(requests)
+
+    async def scan_channel(channel_id):
+        ch = client.get_channel(channel_id)
+        if not ch: return None
+        after_id, before_id = windows[channel_id]
+        before = discord.Object(id=before_id) if before_id is not None else None
+        print(f"   共用掃描: #{ch.name}")
+        return [msg async for msg in ch.history(after=discord.Object(id=after_id), before=before, limit=None)]
+
+    channel_ids = list(windows)
+    results = await gather_channels(channel_ids, scan_channel, concurrency)
+    messages = {cid: msgs for cid, msgs in zip(channel_ids, results) if msgs is not None}
+    print(f"   共用掃描完成: {len(messages)} 個頻道，共 {sum(len(m) for m in messages.values())} 則訊息")
+    return HistorySnapshot(windows, messages)
+
+
+async def channel_history(ch, after, before=None, snapshot=None):
+    """
+    取代 ch.history(after=..., before=..., limit=None) 的迭代來源：
+    若共用快照已涵蓋此時間窗則直接讀記憶體，否則向 Discord 抓取
+    """
+    if snapshot is not None and snapshot.covers(ch.id, after, before):
+        for msg in snapshot.view(ch.id, after, before):
+            yield msg
+        return
+    async for msg in ch.history(after=after, before=before, limit=None):
+        yield msg
@@ -1,10 +1,12 @@
 import discord
 import asyncio
 import os
-import re
+import csv
+import json
 import argparse
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from transcript import normalize_message, URL_RE, EMOJI_RE
 
 # 設定部：可以根據需求調整
 NAME_LIMIT = 4        # 名字顯示長度
@@ -21,9 +23,147 @@ DEFAULT_DAYS = 30
 # 範例: DEFAULT_CHANNELS = [121...738, 7458...152]
 DEFAULT_CHANNELS = [1162833322435690597,745840586510041152,1219637392848457738] 
 
-async def get_messages(days=1, channel_ids=None):
+# 共用訊息清理模組 (transcript.py) 使用的設定 (--normalize 時使用)
+NORMALIZE_SETTINGS = {
+    "IGNORE_TOKEN": IGNORE_TOKEN,
+    "AUTHOR_NAME_LIMIT": NAME_LIMIT,
+    "MAX_MSG_LENGTH": MAX_MSG_LEN,
+    "SIMPLIFY_LINKS": True,
+    "BOT_NAME": "機器人",
+}
+
+# 匯出格式與寫檔緩衝 (累積幾行就寫入並 flush 一次)
+OUTPUT_FORMATS = ("txt", "jsonl", "csv")
+FLUSH_EVERY = 500
+
+CSV_FIELDS = ["channel_id", "channel", "message_id", "time", "author_id", "author", "content", "attachments"]
+
+
+def _domain_replacer(match):
+    url = match.group(0)
+    try:
+        no_proto = url.split("://", 1)[1]
+        return f"(連結 {no_proto.split('/', 1)[0]})"
+    except IndexError:
+        return url
+
+
+def clean_message(msg):
     """
-    抓取指定頻道在過去 X 天內的訊息並清理
+    預設的清理方式 (與先前的匯出檔相同，可直接比對)：截斷字元、連結僅留網域、貼圖、用戶 Mentions、長度截斷
+    回傳與 normalize_message 相同欄位的紀錄，內容與附件皆為空則回傳 None
+    """
+    content = msg.content
+    if IGNORE_TOKEN and IGNORE_TOKEN in content:
+        content = content.split(IGNORE_TOKEN)[0]
+    content = URL_RE.sub(_domain_replacer, content)
+    content = EMOJI_RE.sub("(貼圖)", content)
+    for user in msg.mentions:
+        u_name = user.display_name[:NAME_LIMIT]
+        content = content.replace(f"<@{user.id}>", f"@{u_name}").replace(f"<@!{user.id}>", f"@{u_name}")
+    if len(content) > MAX_MSG_LEN:
+        content = content[:MAX_MSG_LEN] + "..."
+    if not content.strip() and not msg.attachments:
+        return None
+    return {"content": content, "attachments": [a.url for a in msg.attachments]}
+
+
+class StreamingExporter:
+    """
+    邊抓邊寫的匯出器：只保留有限行數的緩衝，滿了就寫檔並 flush
+    記憶體用量與匯出天數無關，中途中斷也只會損失最後一個緩衝
+    txt: 與舊版相同的純文字格式 / jsonl: 每行一個 JSON / csv: 含標題列
+    """
+
+    def __init__(self, path, fmt="txt", flush_every=FLUSH_EVERY, append=False, truncate_to=None):
+        self.path = path
+        self.fmt = fmt
+        self.flush_every = max(1, flush_every)
+        self.count = 0
+        self.buffer = []
+        # 續傳時先截掉檢查點之後才寫入的內容 (強制中斷時緩衝可能已寫出，但檢查點尚未記錄)
+        if append and truncate_to is not None and os.path.exists(path) and os.path.getsize(path) > truncate_to:
+            print(f"✂️ 截掉輸出檔中檢查點之後的 {os.path.getsize(path) - truncate_to} bytes (避免重複匯出)")
+            os.truncate(path, truncate_to)
+        # 續傳時接在既有檔案後面 (CSV 不重複寫標題列)
+        write_header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+        self.file = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self.csv_writer = None
+        if fmt == "csv":
+            self.csv_writer = csv.writer(self)
+            if write_header:
+                self.csv_writer.writerow(CSV_FIELDS)
+
+    def write(self, text):
+        """供 csv.writer 使用的寫入介面，也用於直接寫入文字"""
+        self.buffer.append(text)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def write_channel_header(self, channel):
+        if self.fmt == "txt":
+            self.write(f"\n--- [#{channel.name}] ---\n")
+
+    def write_message(self, channel, msg, record, line):
+        self.count += 1
+        if self.fmt == "txt":
+            self.write(line + "\n")
+            return
+        row = {
+            "channel_id": channel.id,
+            "channel": channel.name,
+            "message_id": msg.id,
+            "time": msg.created_at.astimezone(TZ).isoformat(),
+            "author_id": msg.author.id,
+            "author": msg.author.display_name,
+            "content": record["content"],
+            "attachments": record["attachments"],
+        }
+        if self.fmt == "jsonl":
+            self.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            row["attachments"] = " ".join(row["attachments"])
+            self.csv_writer.writerow([row[k] for k in CSV_FIELDS])
+
+    def flush(self):
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer.clear()
+        self.file.flush()
+
+    def offset(self):
+        """目前已寫入檔案的位元組數 (flush 之後呼叫才包含緩衝內容)"""
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load_checkpoint(state_path):
+    """讀取續傳狀態檔，不存在或損毀則回傳 None"""
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(state_path, state):
+    """寫入續傳狀態檔 (先寫暫存檔再替換，避免中斷時寫出半個檔案)"""
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+async def get_messages(days=1, channel_ids=None, output_format="txt", output_path=None, quiet=False, resume=False,
+                       normalize=False):
+    """
+    抓取指定頻道在過去 X 天內的訊息並清理，邊抓邊寫入檔案
+    quiet: 不逐行輸出到終端機，只顯示進度
+    resume: 依狀態檔 (<輸出檔>.state.json) 從各頻道上次匯出的最後一則訊息之後繼續
+    normalize: 改用機器人共用的完整清理 (transcript.normalize_message)，輸出內容與預設不同
     """
     load_dotenv()
     token = os.getenv('DISCORD_BOT_TOKEN')
@@ -56,75 +196,111 @@ async def get_messages(days=1, channel_ids=None):
 
     # 將主要抓取邏輯封裝，避免在 on_ready 中直接 call close()
     async def run_scraper():
-        now = datetime.now(TZ)
-        after_date = now - timedelta(days=days)
+        path = output_path or f"messages_output.{output_format}"
+        state_path = f"{path}.state.json"
+
+        # 續傳：沿用上次的起始時間與各頻道進度
+        state = load_checkpoint(state_path) if resume else None
+        if resume and not state:
+            print(f"⚠️ 找不到續傳狀態檔 {state_path}，改為重新匯出")
+        if state and state.get("format") != output_format:
+            print(f"❌ 續傳格式不一致 (上次: {state.get('format')}, 這次: {output_format})")
+            return
+        if state and state.get("normalize", False) != normalize:
+            print(f"❌ 續傳的清理方式不一致 (上次 --normalize: {state.get('normalize', False)}, 這次: {normalize})")
+            return
+        if state:
+            after_date = datetime.fromisoformat(state["after"])
+            print(f"🔁 續傳模式: 沿用上次的抓取範圍")
+        else:
+            after_date = datetime.now(TZ) - timedelta(days=days)
+            state = {"after": after_date.isoformat(), "format": output_format, "normalize": normalize, "channels": {}}
         print(f"🕒 抓取範圍: {after_date.strftime('%Y-%m-%d %H:%M:%S')} 之後的訊息")
-        
-        results = []
-        for ch_id in channel_ids:
-            channel = client.get_channel(ch_id)
-            if not channel:
-                try:
-                    channel = await client.fetch_channel(ch_id)
-                except Exception as e:
-                    print(f"⚠️ 無法取得頻道 {ch_id}: {e}")
+
+        exporter = StreamingExporter(path, output_format, append=bool(resume and state["channels"]),
+                                     truncate_to=state.get("offset"))
+        print(f"💾 邊抓邊寫入: {path} (格式: {output_format}，進度檔: {state_path})")
+
+        def checkpoint():
+            # 先 flush 再記錄檔案大小，續傳時截回此位置，檢查點與輸出檔永遠一致
+            exporter.flush()
+            state["offset"] = exporter.offset()
+            save_checkpoint(state_path, state)
+
+        checkpoint()
+
+        try:
+            for ch_id in channel_ids:
+                progress = state["channels"].setdefault(str(ch_id), {"last_id": None, "count": 0, "done": False})
+                if progress["done"]:
+                    print(f"⏭️ 頻道 {ch_id} 已匯出完成 ({progress['count']} 則)，跳過")
                     continue
-            
-            print(f"📂 正在處理頻道: #{channel.name} ({ch_id})")
-            results.append(f"\n--- [#{channel.name}] ---")
-            
-            count = 0
-            async for msg in channel.history(after=after_date, limit=None):
-                content = msg.content
-                
-                # 實作「截斷字元」邏輯：若內容中出現此符號，則只保留標記之前的部分
-                if IGNORE_TOKEN and IGNORE_TOKEN in content:
-                    content = content.split(IGNORE_TOKEN)[0]
-                
-                # 簡化連結
-                def domain_replacer(match):
-                    url = match.group(0)
+
+                channel = client.get_channel(ch_id)
+                if not channel:
                     try:
-                        no_proto = url.split("://", 1)[1]
-                        return f"(連結 {no_proto.split('/', 1)[0]})"
-                    except: return url
-                content = re.sub(r'https?://\S+', domain_replacer, content)
-                content = re.sub(r'<a?:\w+:\d+>', '(貼圖)', content)
+                        channel = await client.fetch_channel(ch_id)
+                    except Exception as e:
+                        print(f"⚠️ 無法取得頻道 {ch_id}: {e}")
+                        continue
                 
-                if msg.mentions:
-                    for user in msg.mentions:
-                        u_name = user.display_name[:NAME_LIMIT]
-                        content = content.replace(f"<@{user.id}>", f"@{u_name}")
-                        content = content.replace(f"<@!{user.id}>", f"@{u_name}")
-
-                if len(content) > MAX_MSG_LEN:
-                    content = content[:MAX_MSG_LEN] + "..."
+                # 從檢查點之後繼續 (snowflake ID 可直接當作 after 的起點)
+                last_id = progress["last_id"]
+                history_after = discord.Object(id=last_id) if last_id else after_date
+                if last_id:
+                    print(f"📂 繼續處理頻道: #{channel.name} ({ch_id})，已匯出 {progress['count']} 則")
+                else:
+                    print(f"📂 正在處理頻道: #{channel.name} ({ch_id})")
+                    exporter.write_channel_header(channel)
                 
-                if not content.strip() and not msg.attachments:
-                    continue
+                count = 0
+                async for msg in channel.history(after=history_after, limit=None):
+                    # 邊界去重：檢查點那一則 (含) 之前的訊息已經匯出過
+                    if last_id and msg.id <= last_id:
+                        continue
 
-                author_name = msg.author.display_name[:NAME_LIMIT]
-                timestamp = msg.created_at.astimezone(TZ).strftime("%H:%M")
-                
-                line = f"[{timestamp}] {author_name}: {content}"
-                if msg.attachments:
-                    line += " (附件)"
+                    # 截斷字元、連結簡化、貼圖、Mentions、長度截斷
+                    if normalize:
+                        record = normalize_message(msg, client.user.id, NORMALIZE_SETTINGS)
+                    else:
+                        record = clean_message(msg)
+                    if not record:
+                        progress["last_id"] = msg.id
+                        continue
+                    content = record["content"]
+
+                    author_name = msg.author.display_name[:NAME_LIMIT]
+                    timestamp = msg.created_at.astimezone(TZ).strftime("%H:%M")
+                    
+                    line = f"[{timestamp}] {author_name}: {content}"
+                    if msg.attachments:
+                        line += " (附件)"
+                    
+                    exporter.write_message(channel, msg, record, line)
+                    progress["last_id"] = msg.id
+                    count += 1
+                    progress["count"] += 1
+                    if not quiet:
+                        print(line)
+                    elif count % 1000 == 0:
+                        print(f"   ⏳ #{channel.name} 已匯出 {progress['count']} 則...")
+
+                    # 定期寫入檢查點
+                    if count % FLUSH_EVERY == 0:
+                        checkpoint()
                 
-                print(line)
-                results.append(line)
-                count += 1
-            
-            print(f"   ✅ 頻道 #{channel.name} 處理完成，共 {count} 則訊息")
-
-        output_text = "\n".join(results)
-        if output_text.strip():
-            print("\n" + "="*30 + "\n抓取結果：\n" + "="*30)
-            print(output_text)
-            with open("messages_output.txt", "w", encoding="utf-8") as f:
-                f.write(output_text)
-            print(f"\n💾 結果已存至 messages_output.txt")
+                progress["done"] = True
+                checkpoint()
+                print(f"   ✅ 頻道 #{channel.name} 處理完成，本次 {count} 則 (累計 {progress['count']} 則)")
+        finally:
+            # 中斷時也把緩衝寫完並記下進度，下次可用 --resume 接續
+            checkpoint()
+            exporter.close()
+
+        if exporter.count:
+            print(f"\n💾 本次共 {exporter.count} 則訊息，已存至 {path}")
         else:
-            print("\nℹ️ 該期間內沒有任何訊息。")
+            print("\nℹ️ 該期間內沒有任何新訊息。")
 
     @client.event
     async def on_ready():
@@ -147,6 +323,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="抓取特定期間內的 Discord 訊息並清理")
     parser.add_argument("--days", type=float, default=DEFAULT_DAYS, help=f"追蹤天數 (目前設定預設為 {DEFAULT_DAYS})")
     parser.add_argument("--channels", type=str, help="頻道 ID (逗號分隔，若無則抓腳本頂部設定或 .env)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="txt", help="匯出格式 (預設 txt)")
+    parser.add_argument("--output", type=str, help="輸出檔案路徑 (預設 messages_output.<格式>)")
+    parser.add_argument("--quiet", action="store_true", help="不逐行輸出訊息到終端機，只顯示進度")
+    parser.add_argument("--resume", action="store_true", help="從上次中斷的進度繼續 (讀取 <輸出檔>.state.json)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="使用與機器人相同的完整清理 (Embed 標題、轉發內容、身分組 / 頻道 Mentions、Bot 改名)，輸出與預設格式不同")
     
     args = parser.parse_args()
     
@@ -154,4 +336,6 @@ if __name__ == "__main__":
     if args.channels:
         ch_list = [int(x.strip()) for x in args.channels.split(',') if x.strip()]
     
-    asyncio.run(get_messages(days=args.days, channel_ids=ch_list))
+    asyncio.run(get_messages(days=args.days, channel_ids=ch_list,
+                             output_format=args.format, output_path=args.output, quiet=args.quiet,
+                             resume=args.resume, normalize=args.normalize))
@@ -0,0 +1,31 @@
+# history_fetcher.py
+# 多頻道並行抓取：以 Semaphore 限制同時抓取的頻道數，結果仍依傳入的頻道順序回傳
+#
+# 速率限制說明：
+# discord.py 的 HTTPClient 本身會依 rate-limit bucket 排隊，遇到 429 也會自動等待重試。
+# 訊息歷史的 bucket 以 channel_id 區分，因此不同頻道可以同時抓；
+# 這裡的 Semaphore 只是額外限制同時在跑的頻道數，避免一次衝太多請求撞到全域上限。
+
+import asyncio
+
+
+async def gather_channels(channel_ids, fetch_one, concurrency=4, failed=None):
+    """
+    並行執行 fetch_one(channel_id)，回傳與 channel_ids 順序一致的結果 list
+    單一頻道失敗時印出錯誤並以 None 代替，不影響其他頻道
+    failed: 選填 list，失敗的頻道 ID 會依 channel_ids 的順序加入 (供報告標示缺少的頻道)
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def worker(channel_id):
+        async with semaphore:
+            try:
+                return await fetch_one(channel_id)
+            except Exception as e:
+                print(f"   ⚠️ 頻道 {channel_id} 抓取失敗: {e}")
+                return e
+
+    results = await asyncio.gather(*(worker(channel_id) for channel_id in channel_ids))
+    if failed is not None:
+        failed.extend(channel_id for channel_id, result in zip(channel_ids, results) if isinstance(result, Exception))
+    return [None if isinstance(result, Exception) else result for result in results]
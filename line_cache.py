@@ -0,0 +1,74 @@
+# line_cache.py
+# 逐字稿單行快取：以訊息 ID 為 key 保存 normalize_message + format_line 的結果 (LRU)，
+# 活躍頻道連續被提及時對話歷史大多相同，每次只需整理新訊息
+#
+# 整理結果取決於訊息內容、作者與被提及用戶的顯示名稱，因此：
+# - 訊息被編輯 / 刪除 -> invalidate_message()
+# - 用戶改暱稱或名稱 -> invalidate_user() (以作者與被提及用戶建立反向索引)
+# - 身分組 / 頻道改名 (少見) -> clear()
+
+from collections import OrderedDict
+
+from transcript import normalize_message, format_line
+
+
+class LineCache:
+    def __init__(self, maxsize=2000):
+        self.maxsize = maxsize  # 0 = 停用
+        self.entries = OrderedDict()  # (message_id, max_length, time_fmt) -> (record, line, 相關用戶 ID)
+        self.by_message = {}  # message_id -> {key, ...}
+        self.by_user = {}     # user_id -> {key, ...} (作者與被提及的用戶)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def format(self, msg, bot_user_id, settings, max_length, time_fmt):
+        """回傳 (record, line)；訊息沒有可用內容時回傳 (None, None)"""
+        key = (msg.id, max_length, time_fmt)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0], entry[1]
+
+        self.stats["misses"] += 1
+        record = normalize_message(msg, bot_user_id, settings, max_length)
+        line = format_line(record, settings, time_fmt) if record else None
+        if self.maxsize <= 0:
+            return record, line
+
+        user_ids = {msg.author.id, *(user.id for user in msg.mentions)}
+        self.entries[key] = (record, line, user_ids)
+        self.by_message.setdefault(msg.id, set()).add(key)
+        for user_id in user_ids:
+            self.by_user.setdefault(user_id, set()).add(key)
+        while len(self.entries) > self.maxsize:
+            self._drop(next(iter(self.entries)))
+        return record, line
+
+    @staticmethod
+    def _unindex(index, index_key, key):
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self._unindex(self.by_message, key[0], key)
+        for user_id in entry[2]:
+            self._unindex(self.by_user, user_id, key)
+
+    def invalidate_message(self, message_id):
+        for key in list(self.by_message.get(message_id, ())):
+            self._drop(key)
+
+    def invalidate_user(self, user_id):
+        for key in list(self.by_user.get(user_id, ())):
+            self._drop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_message.clear()
+        self.by_user.clear()
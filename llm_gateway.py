@@ -0,0 +1,448 @@
+# llm_gateway.py
+# 共用的 LLM 呼叫入口：server.py / tagged_reply.py 共用
+# - 每個行程只建立一個長駐的 genai.Client，底層 HTTP 連線 (TLS) 在多次呼叫間重複使用
+# - 統一的模型回退策略：依優先順序嘗試，每次呼叫有逾時，暫時性錯誤 (逾時 / 5xx) 會在同一模型重試
+# - 記錄每次呼叫的 token 用量 (usage_metadata)，並累計各模型的總用量
+# - 若有 ModelHealth，依健康狀態跳過斷路器開啟中的模型，並回報每次呼叫的成敗與延遲
+# - 若有 ResponseCache，cacheable=True 的請求會先查快取，成功的回應寫回快取
+# - 若有 ModelRateLimiter，送出前先預約 RPM / TPM 額度，額度不足時短暫排隊或改用下一個模型
+# - hedge=True 時，第一個模型超過延遲百分位門檻仍未回應，就同時向下一個模型送出請求，取先回來的結果
+# - generate_stream() 以串流方式取得回應，收到第一段文字前失敗才改用下一個模型
+# - 相同的請求 (模型 + contents + config) 同時進行時只送出一次，其餘呼叫共用結果 (singleflight.py)；
+#   contents 含有每次都不同的內容 (例如對話歷史) 時，呼叫端可用 flight_key 指定真正決定結果的部分
+
+import asyncio
+import inspect
+import time
+from collections import OrderedDict, deque
+
+from google import genai
+from google.genai import types
+
+from response_cache import request_key
+from singleflight import SingleFlight
+from transcript import estimate_tokens
+
+# 非文字 Part (例如圖片) 的 token 估計值
+NON_TEXT_PART_TOKENS = 258
+# 暫時性錯誤：同一模型稍候重試可能成功；429 (配額) 重試無益，直接換下一個模型
+RETRYABLE_CODES = (500, 502, 503, 504)
+USAGE_FIELDS = (
+    "prompt_token_count",
+    "candidates_token_count",
+    "cached_content_token_count",
+    "thoughts_token_count",
+    "total_token_count",
+)
+
+
+def error_code(error):
+    """取出 API 錯誤的 HTTP 狀態碼 (google.genai.errors.APIError.code)，逾時視為 504"""
+    if isinstance(error, asyncio.TimeoutError):
+        return 504
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    text = str(error)
+    if "429" in text or "Resource has been exhausted" in text:
+        return 429
+    if "503" in text or "Service Unavailable" in text:
+        return 503
+    return None
+
+
+class RateLimitExceeded(Exception):
+    """本機速率限制判定此模型的額度不足 (未實際送出請求)"""
+    code = 429
+
+
+def estimate_request_tokens(contents):
+    """離線估算請求的輸入 token 數 (供 TPM 預約用)"""
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    total = 0
+    for part in contents or ():
+        total += estimate_tokens(part) if isinstance(part, str) else NON_TEXT_PART_TOKENS
+    return total
+
+
+def percentile(samples, p):
+    """nearest-rank 百分位數 (samples 為空時回傳 None)"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def usage_to_dict(usage_metadata):
+    """usage_metadata -> {欄位: 數值}，缺少的欄位略過"""
+    if usage_metadata is None:
+        return {}
+    usage = {}
+    for field in USAGE_FIELDS:
+        value = getattr(usage_metadata, field, None)
+        if value:
+            usage[field] = value
+    return usage
+
+
+class GenerationResult:
+    """一次 generate() 的結果：成功的文字與模型、用量，以及途中各模型的錯誤"""
+
+    def __init__(self):
+        self.text = None
+        self.model = None
+        self.usage = {}
+        self.latency = None
+        self.cached = False
+        self.interrupted = False  # 串流途中斷線 (text 只有部分內容)
+        self.errors = []  # [(model_name, exception), ...]
+
+    @property
+    def ok(self):
+        return bool(self.text)
+
+    @property
+    def last_error(self):
+        return self.errors[-1][1] if self.errors else None
+
+
+class LLMGateway:
+    def __init__(self, api_key, timeout=180, retries=1, retry_backoff=1.0, health=None,
+                 cache=None, cache_bypass=False, limiter=None, max_queue_wait=3.0,
+                 hedge_percentile=90, hedge_default_delay=8.0, hedge_min_samples=20, base_url=None):
+        # base_url: 改連到其他端點 (例如本機的 mock_gemini_server.py)
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.health = health
+        self.cache = cache
+        self.cache_bypass = cache_bypass  # True: 不讀快取 (強制取得新回應)，但仍會寫入
+        self.limiter = limiter
+        self.max_queue_wait = max_queue_wait  # 額度不足時最多排隊幾秒，超過則改用下一個模型
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.usage_totals = {}  # model -> {"calls": n, 欄位: 累計值}
+        # Hedging：以各模型最近的成功延遲決定門檻，樣本不足時使用預設秒數
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.model_latencies = {}  # model -> deque(最近的成功延遲)
+        self.request_latencies = deque(maxlen=500)  # generate() 端到端延遲 (不含快取命中)
+        self.hedge_stats = {"requests": 0, "fired": 0, "won": 0}
+        self.token_counts = OrderedDict()  # request_key -> count_tokens 結果 (LRU)
+        self.singleflight = SingleFlight()  # 相同請求同時進行時只送出一次
+
+    async def _call(self, model_name, contents, config):
+        """單一模型呼叫 (含逾時與暫時性錯誤重試)，失敗時拋出最後一次的例外"""
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.wait_for(
+                    self.client.aio.models.generate_content(model=model_name, contents=contents, config=config),
+                    timeout=self.timeout,
+                )
+            except Exception as e:
+                if attempt >= self.retries or error_code(e) not in RETRYABLE_CODES:
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                reason = f"逾時 ({self.timeout}s)" if isinstance(e, asyncio.TimeoutError) else e
+                print(f"   🔁 模型 {model_name} 暫時性錯誤，{delay:.1f}s 後重試: {reason}")
+                await asyncio.sleep(delay)
+
+    def _record_usage(self, model_name, usage):
+        totals = self.usage_totals.setdefault(model_name, {"calls": 0})
+        totals["calls"] += 1
+        for field, value in usage.items():
+            totals[field] = totals.get(field, 0) + value
+
+    def _record_failure(self, model_name, error, label, result=None):
+        """模型呼叫失敗的共用處理：印出原因 (逾時 / 錯誤)、回報健康狀態，有 result 則一併記錄"""
+        reason = f"逾時 ({self.timeout}s)" if isinstance(error, asyncio.TimeoutError) else error
+        print(f"   ⚠️ {label}模型 {model_name} 失敗: {reason}")
+        if self.health is not None:
+            self.health.record_failure(model_name, error_code(error), str(error))
+        if result is not None:
+            result.errors.append((model_name, error))
+
+    async def _admit(self, model_name, tokens, label):
+        """向速率限制預約額度；回傳 True 表示可以送出 (必要時已排隊等待)"""
+        if self.limiter is None:
+            return True
+        delay = self.limiter.reserve(model_name, tokens, self.max_queue_wait)
+        if delay is None:
+            print(f"   ⏭️ {label}模型 {model_name} 本機速率限制額度不足，改用下一個模型")
+            return False
+        if delay > 0:
+            print(f"   ⏳ {label}模型 {model_name} 額度排隊 {delay:.1f}s")
+            await asyncio.sleep(delay)
+        return True
+
+    async def _prepare(self, prepare, model_name, contents, config):
+        """prepare 可為一般函式或 async 函式；沒有 prepare 則沿用傳入的 contents / config"""
+        if prepare is None:
+            return contents, config
+        request = prepare(model_name)
+        if inspect.isawaitable(request):
+            request = await request
+        return request
+
+    async def _cache_lookup(self, result, model_list, contents, config, prepare, label):
+        """依優先順序找第一個有快取的模型 (快取命中不需呼叫 API，因此不看健康狀態)"""
+        for model_name in model_list:
+            contents, config = await self._prepare(prepare, model_name, contents, config)
+            hit = self.cache.get(request_key(model_name, contents, config))
+            if hit:
+                result.text, result.usage = hit
+                result.model = model_name
+                result.latency = 0.0
+                result.cached = True
+                print(f"   💾 {label}使用快取回應 (模型 {model_name})")
+                return True
+        return False
+
+    def hedge_delay(self, model_name):
+        """此模型的 hedging 門檻秒數 (最近延遲的第 hedge_percentile 百分位)"""
+        samples = self.model_latencies.get(model_name)
+        if not samples or len(samples) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return percentile(samples, self.hedge_percentile)
+
+    async def _execute(self, model_name, contents, config, label):
+        """
+        實際送出一次請求 (額度預約 + 呼叫 + 記錄用量與健康狀態)，回傳 (text, usage, latency)
+        失敗時記錄健康狀態後拋出例外；由 single-flight 執行，相同請求同時只會有一次
+        """
+        estimated_tokens = estimate_request_tokens(contents)
+        if not await self._admit(model_name, estimated_tokens, label):
+            raise RateLimitExceeded(f"429 本機速率限制: 模型 {model_name} 每分鐘額度已滿")
+        print(f"   🔄 {label}嘗試模型: {model_name}...")
+        started = time.monotonic()
+        try:
+            response = await self._call(model_name, contents, config)
+        except Exception as e:
+            # result 由 _try_model 記錄 (共用同一次呼叫的每個請求各自記錄)
+            self._record_failure(model_name, e, label)
+            raise
+
+        usage = usage_to_dict(getattr(response, "usage_metadata", None))
+        self._record_usage(model_name, usage)
+        if self.limiter is not None and usage.get("prompt_token_count"):
+            self.limiter.adjust_tokens(model_name, usage["prompt_token_count"] - estimated_tokens)
+        latency = time.monotonic() - started
+        if not response.text:
+            print(f"   ⚠️ {label}模型 {model_name} 未回傳文字")
+            return None, usage, latency
+
+        self.model_latencies.setdefault(model_name, deque(maxlen=200)).append(latency)
+        if self.health is not None:
+            self.health.record_success(model_name, latency)
+        print(f"   ✅ {label}模型 {model_name} 成功回應 ({latency:.1f}s, 用量: {usage})")
+        return response.text, usage, latency
+
+    async def _try_model(self, result, model_name, contents, config, label, use_cache, flight_key=None):
+        """
+        嘗試單一模型，成功回傳 (text, usage, latency)，失敗記錄錯誤並回傳 None
+        相同的請求 (模型 + contents + config，有 flight_key 則以它取代 contents) 正在進行中時，直接共用該次結果
+        被取消 (hedging 輸家) 時直接拋出 CancelledError，不記錄任何結果
+        """
+        key = request_key(model_name, contents, config)
+        shared_key = key if flight_key is None else request_key(model_name, flight_key, config)
+        if self.singleflight.in_flight(shared_key):
+            print(f"   🔗 {label}模型 {model_name} 有相同的請求進行中，共用其結果")
+        try:
+            text, usage, latency = await self.singleflight.do(
+                shared_key, lambda: self._execute(model_name, contents, config, label))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result.errors.append((model_name, e))
+            return None
+        if not text:
+            return None
+
+        if use_cache:
+            self.cache.put(key, model_name, text, usage)
+        return text, usage, latency
+
+    async def _try_hedged(self, result, primary, backup, prepare, contents, config, label, use_cache, flight_key):
+        """
+        先送 primary，超過門檻仍未回應就同時送 backup，取先成功的結果並取消另一個
+        回傳 (winner 模型名稱, outcome, 是否已嘗試 backup)
+        """
+        request = await self._prepare(prepare, primary, contents, config)
+        primary_task = asyncio.create_task(self._try_model(result, primary, *request, label, use_cache, flight_key))
+        delay = self.hedge_delay(primary)
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return primary, primary_task.result(), False
+
+        print(f"   🪁 {label}模型 {primary} 超過 {delay:.1f}s 未回應，同時嘗試 {backup}")
+        self.hedge_stats["fired"] += 1
+        request = await self._prepare(prepare, backup, contents, config)
+        backup_task = asyncio.create_task(self._try_model(result, backup, *request, label, use_cache, flight_key))
+        tasks = {primary_task: primary, backup_task: backup}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = task.result()
+                    if outcome:
+                        if task is backup_task:
+                            self.hedge_stats["won"] += 1
+                        return tasks[task], outcome, True
+        finally:
+            for task in pending:
+                task.cancel()
+        return None, None, True
+
+    async def generate(self, model_list, contents=None, config=None, prepare=None, label="", cacheable=False,
+                       hedge=False, flight_key=None):
+        """
+        依優先順序嘗試 model_list，回傳第一個有文字的 GenerationResult
+        prepare: 選填 callable(model_name) -> (contents, config) (可為 async)，供不同模型使用不同 prompt / 參數
+        cacheable: 是否使用回應快取 (相同的模型 + prompt + 參數直接回傳上次結果)
+        hedge: 是否啟用 hedged request (第一個模型太慢時同時嘗試下一個模型)
+        flight_key: 選填，合併同時進行的相同請求時取代 contents 作為比對依據
+                    (例如圖片辨識只看「圖片 + 指令」，不看每次都不同的對話歷史)
+        """
+        result = GenerationResult()
+        use_cache = cacheable and self.cache is not None
+        if use_cache and not self.cache_bypass:
+            if await self._cache_lookup(result, model_list, contents, config, prepare, label):
+                return result
+        if self.health is not None:
+            model_list, skipped = self.health.order(model_list)
+            if skipped:
+                print(f"   ⏭️ {label}略過暫時不可用的模型: {skipped}")
+
+        started = time.monotonic()
+        if hedge:
+            self.hedge_stats["requests"] += 1
+        index = 0
+        while index < len(model_list):
+            model_name = model_list[index]
+            if hedge and index == 0 and len(model_list) > 1:
+                model_name, outcome, backup_tried = await self._try_hedged(
+                    result, model_list[0], model_list[1], prepare, contents, config, label, use_cache, flight_key)
+                index += 2 if backup_tried else 1
+            else:
+                request = await self._prepare(prepare, model_name, contents, config)
+                outcome = await self._try_model(result, model_name, *request, label, use_cache, flight_key)
+                index += 1
+            if outcome:
+                result.text, result.usage, result.latency = outcome
+                result.model = model_name
+                break
+        self.request_latencies.append(time.monotonic() - started)
+        return result
+
+    async def generate_stream(self, model_list, on_text, contents=None, config=None, prepare=None, label=""):
+        """
+        串流版 generate()：每收到一段文字就以「目前累積的全文」呼叫 await on_text(text)
+        收到第一段文字之前失敗 (錯誤 / 逾時 / 額度不足) 會改用下一個模型；
+        之後才中斷則保留已收到的內容並標記 result.interrupted
+        逾時 (self.timeout) 以「兩段文字之間」的等待時間計算
+        """
+        result = GenerationResult()
+        if self.health is not None:
+            model_list, skipped = self.health.order(model_list)
+            if skipped:
+                print(f"   ⏭️ {label}略過暫時不可用的模型: {skipped}")
+
+        started = time.monotonic()
+        for model_name in model_list:
+            contents, config = await self._prepare(prepare, model_name, contents, config)
+            estimated_tokens = estimate_request_tokens(contents)
+            if not await self._admit(model_name, estimated_tokens, label):
+                result.errors.append((model_name, RateLimitExceeded(f"429 本機速率限制: 模型 {model_name} 每分鐘額度已滿")))
+                continue
+
+            print(f"   🔄 {label}串流嘗試模型: {model_name}...")
+            model_started = time.monotonic()
+            text = ""
+            usage_metadata = None
+            try:
+                stream = await asyncio.wait_for(
+                    self.client.aio.models.generate_content_stream(model=model_name, contents=contents, config=config),
+                    timeout=self.timeout,
+                )
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    if chunk.text:
+                        if not text:
+                            print(f"   ⚡ {label}模型 {model_name} 首段文字 ({time.monotonic() - model_started:.1f}s)")
+                        text += chunk.text
+                        await on_text(text)
+            except Exception as e:
+                if not text:
+                    self._record_failure(model_name, e, label, result)
+                    continue
+                reason = f"逾時 ({self.timeout}s)" if isinstance(e, asyncio.TimeoutError) else e
+                print(f"   ⚠️ {label}模型 {model_name} 串流中斷: {reason}")
+                result.errors.append((model_name, e))
+                result.interrupted = True
+
+            usage = usage_to_dict(usage_metadata)
+            self._record_usage(model_name, usage)
+            if self.limiter is not None and usage.get("prompt_token_count"):
+                self.limiter.adjust_tokens(model_name, usage["prompt_token_count"] - estimated_tokens)
+            if not text:
+                print(f"   ⚠️ {label}模型 {model_name} 未回傳文字")
+                continue
+
+            latency = time.monotonic() - model_started
+            if self.health is not None and not result.interrupted:
+                self.health.record_success(model_name, latency)
+            result.text, result.usage, result.latency = text, usage, latency
+            result.model = model_name
+            print(f"   ✅ {label}模型 {model_name} 串流完成 ({latency:.1f}s, 用量: {usage})")
+            break
+        self.request_latencies.append(time.monotonic() - started)
+        return result
+
+    async def count_tokens(self, model_name, contents):
+        """以 API 計算輸入 token 數 (結果快取)，失敗回傳 None (呼叫端改用離線估算)"""
+        key = request_key(model_name, contents, None)
+        if key in self.token_counts:
+            self.token_counts.move_to_end(key)
+            return self.token_counts[key]
+        try:
+            response = await asyncio.wait_for(
+                self.client.aio.models.count_tokens(model=model_name, contents=contents), timeout=10)
+        except Exception as e:
+            print(f"   ⚠️ 模型 {model_name} 計算 token 失敗，改用離線估算: {e}")
+            return None
+        self.token_counts[key] = response.total_tokens
+        if len(self.token_counts) > 256:
+            self.token_counts.popitem(last=False)
+        return response.total_tokens
+
+    def latency_report(self):
+        """端到端延遲 p50/p95/p99 與 hedging 統計 (一行文字)"""
+        samples = list(self.request_latencies)
+        if not samples:
+            return "尚無延遲資料"
+        p50, p95, p99 = (percentile(samples, p) for p in (50, 95, 99))
+        stats = self.hedge_stats
+        return (
+            f"延遲 p50 {p50:.1f}s / p95 {p95:.1f}s / p99 {p99:.1f}s (n={len(samples)})，"
+            f"hedge 請求 {stats['requests']}，額外呼叫 {stats['fired']}，備援勝出 {stats['won']}，"
+            f"合併相同請求 {self.singleflight.shared}"
+        )
+
+    def usage_summary(self):
+        """各模型累計用量 (多行文字，供結束時印出)"""
+        return "\n".join(f"   {model}: {totals}" for model, totals in self.usage_totals.items())
+
+    async def aclose(self):
+        """關閉底層 HTTP 連線 (舊版 SDK 沒有 aclose 則略過)"""
+        aclose = getattr(self.client.aio, "aclose", None)
+        if aclose is not None:
+            await aclose()
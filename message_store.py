@@ -0,0 +1,148 @@
+# message_store.py
+# 本地訊息庫：以 SQLite (WAL 模式) 保存已清理過的訊息，並記錄每個頻道的 snowflake 水位
+# 讓排程每次只需向 Discord 要「水位之後」的新訊息，其餘時間窗內的訊息直接從本地讀取
+# - 最近 revalidate_hours 小時內的訊息每次都重新抓取並取代本地紀錄，同步 Discord 上的編輯與刪除
+# - 存的是清理後的紀錄，整理訊息的設定 (fingerprint) 變更時清空重抓，避免沿用舊設定的結果
+
+import json
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+# Discord snowflake 的起始時間 (2015-01-01T00:00:00Z，毫秒)
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_from_datetime(dt):
+    """將時間轉為該時間點最小的 snowflake ID (可直接拿來跟訊息 ID 比大小)"""
+    return int(dt.timestamp() * 1000 - DISCORD_EPOCH) << 22
+
+
+def datetime_from_snowflake(snowflake):
+    """由 snowflake ID 還原建立時間 (UTC)"""
+    return datetime.fromtimestamp(((snowflake >> 22) + DISCORD_EPOCH) / 1000, tz=timezone.utc)
+
+
+class MessageStore:
+    """
+    每個頻道記錄一段「已完整抓取」的區間 [covered_from, last_id]：
+    - 新的時間窗起點落在區間內 -> 只需從 last_id 之後增量抓取
+    - 否則 (第一次執行、或中間有空窗) -> 從時間窗起點重新抓取，並重設區間
+    """
+
+    def __init__(self, path="message_store.db", retention_hours=48, revalidate_hours=0, fingerprint=None):
+        self.path = path
+        self.retention = timedelta(hours=retention_hours)
+        self.revalidate = timedelta(hours=revalidate_hours)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                author_name TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                is_bot INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                attachments TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel_id, id);
+            CREATE TABLE IF NOT EXISTS watermarks (
+                channel_id INTEGER PRIMARY KEY,
+                covered_from INTEGER NOT NULL,
+                last_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        if fingerprint is not None:
+            self._check_fingerprint(fingerprint)
+
+    def _check_fingerprint(self, fingerprint):
+        """整理訊息的設定與寫入時不同 -> 清空訊息與水位 (下次完整重抓)"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row and row[0] == fingerprint:
+            return
+        with self.conn:
+            # 沒有記錄過設定但已有訊息 (舊版建立的訊息庫) 也無法確定，一併清空
+            if row or self.conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+                print("   🧹 訊息整理設定已變更，清空本地訊息庫")
+                self.conn.execute("DELETE FROM messages")
+                self.conn.execute("DELETE FROM watermarks")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)", (fingerprint,))
+
+    def resume_point(self, channel_id, window_start, now=None):
+        """
+        回傳 (after_id, covered_from)
+        after_id: 應向 Discord 要求此 ID 之後的訊息 (本地在此之後的紀錄會被新抓到的取代)
+        covered_from: 抓取完成後，本地完整涵蓋區間的起點
+        """
+        start_id = snowflake_from_datetime(window_start)
+        row = self.conn.execute(
+            "SELECT covered_from, last_id FROM watermarks WHERE channel_id = ?", (channel_id,)
+        ).fetchone()
+        if row and row[0] <= start_id <= row[1]:
+            now = now or datetime.now(timezone.utc)
+            revalidate_id = snowflake_from_datetime(now - self.revalidate)
+            return max(min(row[1], revalidate_id), start_id), row[0]
+        return start_id, start_id
+
+    def save_messages(self, channel_id, records, covered_from, last_id, after_id):
+        """
+        以 after_id 之後重新抓到的訊息取代本地紀錄 (Discord 上已刪除的訊息一併移除)，
+        並推進水位 (同一個 transaction)
+        """
+        rows = [
+            (
+                r["id"], channel_id, r["author_id"], r["author_name"], r["display_name"],
+                int(r["is_bot"]), r["content"], json.dumps(r["attachments"]),
+            )
+            for r in records
+        ]
+        with self.conn:
+            self.conn.execute("DELETE FROM messages WHERE channel_id = ? AND id > ?", (channel_id, after_id))
+            self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO watermarks (channel_id, covered_from, last_id) VALUES (?, ?, ?)",
+                (channel_id, covered_from, last_id),
+            )
+
+    def load_messages(self, channel_id, after, before=None):
+        """讀取頻道在 (after, before) 時間範圍內的訊息紀錄，依時間排序"""
+        after_id = snowflake_from_datetime(after)
+        before_id = snowflake_from_datetime(before) if before else (1 << 63) - 1
+        cursor = self.conn.execute(
+            "SELECT id, author_id, author_name, display_name, is_bot, content, attachments "
+            "FROM messages WHERE channel_id = ? AND id > ? AND id < ? ORDER BY id",
+            (channel_id, after_id, before_id),
+        )
+        return [
+            {
+                "id": row[0],
+                "channel_id": channel_id,
+                "created_at": datetime_from_snowflake(row[0]),
+                "author_id": row[1],
+                "author_name": row[2],
+                "display_name": row[3],
+                "is_bot": bool(row[4]),
+                "content": row[5],
+                "attachments": json.loads(row[6]),
+            }
+            for row in cursor
+        ]
+
+    def prune(self, now=None):
+        """刪除超過保留期限的訊息，並同步收縮各頻道的涵蓋區間"""
+        now = now or datetime.now(timezone.utc)
+        cutoff_id = snowflake_from_datetime(now - self.retention)
+        with self.conn:
+            self.conn.execute("DELETE FROM messages WHERE id < ?", (cutoff_id,))
+            self.conn.execute(
+                "UPDATE watermarks SET covered_from = ? WHERE covered_from < ?", (cutoff_id, cutoff_id)
+            )
+
+    def close(self):
+        self.conn.close()
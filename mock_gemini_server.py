@@ -0,0 +1,292 @@
+# mock_gemini_server.py
+# 本機的 Gemini API 替身伺服器 (只用標準函式庫)，實作機器人用到的子集合：
+#   POST /v1beta/models/{model}:generateContent
+#   POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+#   POST /v1beta/models/{model}:countTokens
+#   POST /v1beta/cachedContents、PATCH / DELETE /v1beta/cachedContents/{id}
+# 可設定各模型的延遲分佈、429 / 503 錯誤注入比例，以及 echo 或固定回應內容，
+# 讓模型回退、hedging、速率限制等行為不需要真的 API Key 也能在本機重現與壓測
+#
+# 執行方式: python3 mock_gemini_server.py [--port 8765] [--config mock.json] [--seed 1]
+# 機器人端設定環境變數 GEMINI_BASE_URL=http://127.0.0.1:8765/ (GEMINI_API_KEY 隨便填) 即可改連到這裡
+#
+# 設定檔範例 (JSON，未列出的模型使用 "default")：
+# {
+#   "mode": "echo",                      # echo=回應包含收到的 prompt 結尾；canned=固定回應 canned_text
+#   "canned_text": "這是測試回應。",
+#   "stream_chunks": 5,                  # 串流時拆成幾段
+#   "models": {
+#     "default": {"latency": {"dist": "lognormal", "median": 1.0, "sigma": 0.5}, "errors": {"429": 0.0, "503": 0.0}},
+#     "gemma-4-31b-it": {"latency": {"dist": "fixed", "seconds": 0.2}, "errors": {"503": 0.1}}
+#   }
+# }
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from transcript import estimate_tokens
+
+MODEL_PATH_RE = re.compile(r"^/v1beta/(?:models/)?([^/:]+):(\w+)$")
+CACHE_PATH_RE = re.compile(r"^/v1beta/cachedContents(?:/([^/]+))?$")
+
+DEFAULT_CONFIG = {
+    "mode": "echo",
+    "canned_text": "這是來自本機測試伺服器的回應。",
+    "stream_chunks": 5,
+    "models": {
+        "default": {"latency": {"dist": "fixed", "seconds": 0.1}, "errors": {}},
+    },
+}
+
+ERROR_BODIES = {
+    429: ("RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota)."),
+    503: ("UNAVAILABLE", "The model is overloaded. Please try again later."),
+}
+
+
+class MockState:
+    """設定與共用狀態 (亂數、cached contents、統計)，各請求執行緒共用，以 lock 保護"""
+
+    def __init__(self, config, seed=None):
+        self.config = config
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.caches = {}  # name -> {"model", "text", "expire_time"}
+        self.stats = {}   # model -> {"requests", "429", "503"}
+
+    def model_config(self, model_name):
+        models = self.config.get("models", {})
+        return models.get(model_name) or models.get("default") or {}
+
+    def sample_latency(self, model_name):
+        latency = self.model_config(model_name).get("latency", {})
+        dist = latency.get("dist", "fixed")
+        with self.lock:
+            if dist == "lognormal":
+                return latency.get("median", 1.0) * math.exp(self.rng.gauss(0, latency.get("sigma", 0.5)))
+            if dist == "uniform":
+                return self.rng.uniform(latency.get("low", 0.0), latency.get("high", 1.0))
+            if dist == "bimodal":
+                # 大部分請求很快，少數很慢 (用來重現尾端延遲)
+                if self.rng.random() < latency.get("slow_ratio", 0.05):
+                    return latency.get("slow", 10.0)
+                return latency.get("fast", 0.5)
+            return latency.get("seconds", 0.1)
+
+    def sample_error(self, model_name):
+        errors = self.model_config(model_name).get("errors", {})
+        with self.lock:
+            stats = self.stats.setdefault(model_name, {"requests": 0, "429": 0, "503": 0})
+            stats["requests"] += 1
+            roll = self.rng.random()
+            for code in ("429", "503"):
+                ratio = errors.get(code, 0.0)
+                if roll < ratio:
+                    stats[code] += 1
+                    return int(code)
+                roll -= ratio
+        return None
+
+
+def request_text(body):
+    """取出請求中所有文字 part (依序串接)"""
+    texts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            if "text" in part:
+                texts.append(part["text"])
+    return "\n".join(texts)
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # 由 make_server 設定
+
+    def log_message(self, format, *args):
+        pass  # 壓測時不印每個請求
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, code, message=None):
+        status, default_message = ERROR_BODIES.get(code, ("INVALID_ARGUMENT", "Bad request."))
+        self._send_json(code, {"error": {"code": code, "message": message or default_message, "status": status}})
+
+    def _reply_text(self, model_name, body):
+        if self.state.config.get("mode") == "canned":
+            return self.state.config.get("canned_text", "")
+        tail = request_text(body)[-200:].replace("\n", " ")
+        return f"[{model_name}] 收到: {tail}"
+
+    def _usage(self, body, text):
+        prompt_tokens = estimate_tokens(request_text(body))
+        usage = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": estimate_tokens(text),
+            "totalTokenCount": prompt_tokens + estimate_tokens(text),
+        }
+        cache = self.state.caches.get(body.get("cachedContent", ""))
+        if cache:
+            cached_tokens = estimate_tokens(cache["text"])
+            usage["cachedContentTokenCount"] = cached_tokens
+            usage["promptTokenCount"] += cached_tokens
+            usage["totalTokenCount"] += cached_tokens
+        return usage
+
+    def _response(self, model_name, text, usage=None, finished=True):
+        candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+        if finished:
+            candidate["finishReason"] = "STOP"
+        payload = {"candidates": [candidate], "modelVersion": model_name}
+        if usage:
+            payload["usageMetadata"] = usage
+        return payload
+
+    def _generate(self, model_name, body, stream):
+        # 錯誤注入先判定，延遲 (模擬排隊) 之後才回錯誤
+        error = self.state.sample_error(model_name)
+        latency = self.state.sample_latency(model_name)
+        if error:
+            time.sleep(min(latency, 1.0))
+            self._send_error(error)
+            return
+
+        text = self._reply_text(model_name, body)
+        usage = self._usage(body, text)
+        if not stream:
+            time.sleep(latency)
+            self._send_json(200, self._response(model_name, text, usage))
+            return
+
+        # SSE：第一段在 latency 後送出 (模擬首字延遲)，其餘段落平均分散在 latency 的一半時間內
+        chunks = max(1, self.state.config.get("stream_chunks", 5))
+        size = max(1, math.ceil(len(text) / chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(latency)
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            payload = self._response(model_name, piece, usage if last else None, finished=last)
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+            if not last:
+                time.sleep(latency / 2 / len(pieces))
+
+    def _create_cache(self, body):
+        model_name = body.get("model", "").split("/")[-1]
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+        expire_time = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        with self.state.lock:
+            self.state.caches[name] = {"model": model_name, "text": request_text(body), "expire_time": expire_time}
+        self._send_json(200, {
+            "name": name,
+            "model": f"models/{model_name}",
+            "expireTime": expire_time.isoformat().replace("+00:00", "Z"),
+            "usageMetadata": {"totalTokenCount": estimate_tokens(request_text(body))},
+        })
+
+    def do_POST(self):
+        try:
+            self._handle_post()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客戶端已放棄這個請求 (例如 hedging 取消了較慢的一方)
+            self.close_connection = True
+
+    def _handle_post(self):
+        path = urlparse(self.path).path
+        body = self._read_json()
+        if CACHE_PATH_RE.match(path):
+            self._create_cache(body)
+            return
+        match = MODEL_PATH_RE.match(path)
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+            return
+        model_name, method = match.groups()
+        if method == "generateContent":
+            self._generate(model_name, body, stream=False)
+        elif method == "streamGenerateContent":
+            self._generate(model_name, body, stream=True)
+        elif method == "countTokens":
+            self._send_json(200, {"totalTokens": estimate_tokens(request_text(body))})
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown method {method}", "status": "NOT_FOUND"}})
+
+    def do_PATCH(self):
+        match = CACHE_PATH_RE.match(urlparse(self.path).path)
+        body = self._read_json()
+        name = f"cachedContents/{match.group(1)}" if match and match.group(1) else None
+        cache = self.state.caches.get(name)
+        if not cache:
+            self._send_json(404, {"error": {"code": 404, "message": "Cached content not found.", "status": "NOT_FOUND"}})
+            return
+        ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+        cache["expire_time"] = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        self._send_json(200, {"name": name, "expireTime": cache["expire_time"].isoformat().replace("+00:00", "Z")})
+
+    def do_DELETE(self):
+        match = CACHE_PATH_RE.match(urlparse(self.path).path)
+        name = f"cachedContents/{match.group(1)}" if match and match.group(1) else None
+        with self.state.lock:
+            self.state.caches.pop(name, None)
+        self._send_json(200, {})
+
+
+def make_server(config=None, seed=None, host="127.0.0.1", port=8765):
+    """建立替身伺服器 (port=0 則自動選擇空的 port)，回傳 (server, state)"""
+    state = MockState({**DEFAULT_CONFIG, **(config or {})}, seed)
+    handler = type("BoundMockGeminiHandler", (MockGeminiHandler,), {"state": state})
+    return ThreadingHTTPServer((host, port), handler), state
+
+
+def start_in_background(config=None, seed=None, host="127.0.0.1", port=0):
+    """在背景執行緒啟動伺服器 (壓測腳本用)，回傳 (server, state, base_url)"""
+    server, state = make_server(config, seed, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機 Gemini API 替身伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--config", help="JSON 設定檔 (延遲分佈 / 錯誤比例 / 回應模式)")
+    parser.add_argument("--seed", type=int, default=None, help="亂數種子 (固定後延遲與錯誤序列可重現)")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+    server, state = make_server(config, args.seed, args.host, args.port)
+    print(f"🧪 Gemini 替身伺服器啟動: http://{args.host}:{args.port}/")
+    print(f"   請設定 GEMINI_BASE_URL=http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n🛑 停止，統計: {state.stats}")
@@ -0,0 +1,128 @@
+# model_health.py
+# 模型健康狀態追蹤 (斷路器)：記錄各模型的失敗、429 與延遲，
+# 連續失敗或配額用盡時暫時跳過該模型 (冷卻期間)，狀態存成 JSON 檔，
+# 讓 tagged_reply.py 常駐行程與 server.py 排程行程共用
+
+import json
+import os
+import time
+
+# 429 (配額用盡) 以外，視為模型本身出問題的錯誤碼；其餘 (例如 400 prompt 有誤) 不計入健康狀態
+UNHEALTHY_CODES = (500, 502, 503, 504)
+
+
+class ModelHealth:
+    """
+    每個模型一筆狀態：
+    - failures: 連續失敗次數 (成功即歸零)，達到門檻即開啟斷路器
+    - open_until: 斷路器開啟到何時 (epoch 秒)，期間內 order() 會跳過此模型
+    - latency: 成功回應延遲的 EWMA (秒)
+    冷卻結束後模型會再被嘗試一次 (half-open)，若仍失敗會立刻再次開啟
+    """
+
+    def __init__(self, path="model_health.json", failure_threshold=3, cooldown_seconds=300,
+                 quota_cooldown_seconds=600, ewma_alpha=0.3):
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.quota_cooldown_seconds = quota_cooldown_seconds
+        self.ewma_alpha = ewma_alpha
+        self.models = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            print(f"   ⚠️ 模型健康狀態檔讀取失敗，重新記錄: {e}")
+            return {}
+
+    def _save(self, model_name):
+        """只合併寫回此模型的狀態 (其他行程可能同時更新別的模型)，以 tmp + rename 原子寫入"""
+        if not self.path:
+            return
+        data = self._load()
+        data[model_name] = self.models[model_name]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"   ⚠️ 模型健康狀態寫入失敗: {e}")
+
+    def _state(self, model_name):
+        return self.models.setdefault(model_name, {
+            "failures": 0,
+            "open_until": 0,
+            "latency": None,
+            "successes": 0,
+            "total_failures": 0,
+            "rate_limited": 0,
+            "last_error": None,
+        })
+
+    def is_open(self, model_name, now=None):
+        state = self.models.get(model_name)
+        return bool(state) and state["open_until"] > (now or time.time())
+
+    def order(self, model_list, now=None):
+        """
+        回傳 (可用模型, 被跳過的模型)，可用模型維持原本的優先順序
+        全部模型的斷路器都開啟時，仍照原順序全部嘗試 (總比直接放棄好)
+        """
+        now = now or time.time()
+        available = [m for m in model_list if not self.is_open(m, now)]
+        skipped = [m for m in model_list if m not in available]
+        if not available:
+            return list(model_list), []
+        return available, skipped
+
+    def record_success(self, model_name, latency):
+        state = self._state(model_name)
+        state["failures"] = 0
+        state["open_until"] = 0
+        state["successes"] += 1
+        if state["latency"] is None:
+            state["latency"] = latency
+        else:
+            state["latency"] += self.ewma_alpha * (latency - state["latency"])
+        self._save(model_name)
+
+    def record_failure(self, model_name, code, error_text=""):
+        """code: HTTP 狀態碼 (逾時為 504)；429 直接進入配額冷卻，其他健康相關錯誤累計到門檻才開啟"""
+        if code != 429 and code not in UNHEALTHY_CODES:
+            return
+        state = self._state(model_name)
+        now = time.time()
+        state["failures"] += 1
+        state["total_failures"] += 1
+        state["last_error"] = f"{code} {error_text}"[:200]
+        if code == 429:
+            state["rate_limited"] += 1
+            state["open_until"] = now + self.quota_cooldown_seconds
+            print(f"   🚫 模型 {model_name} 配額用盡，{self.quota_cooldown_seconds}s 內跳過")
+        elif state["failures"] >= self.failure_threshold:
+            state["open_until"] = now + self.cooldown_seconds
+            print(f"   🚫 模型 {model_name} 連續失敗 {state['failures']} 次，{self.cooldown_seconds}s 內跳過")
+        self._save(model_name)
+
+    def describe(self, model_list):
+        """各模型狀態摘要 (啟動時印出用)"""
+        now = time.time()
+        lines = []
+        for model_name in model_list:
+            state = self.models.get(model_name)
+            if not state:
+                lines.append(f"   {model_name}: 無紀錄")
+                continue
+            status = f"跳過中 (剩 {int(state['open_until'] - now)}s)" if self.is_open(model_name, now) else "正常"
+            latency = f"{state['latency']:.1f}s" if state["latency"] is not None else "-"
+            lines.append(
+                f"   {model_name}: {status}, 延遲 {latency}, 成功 {state['successes']}, "
+                f"失敗 {state['total_failures']} (429: {state['rate_limited']})"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,69 @@
+# rate_limiter.py
+# 客戶端速率限制：每個模型各有「每分鐘請求數 (RPM)」與「每分鐘 token 數 (TPM)」兩個 token bucket，
+# 在送出請求前先扣額度，額度不足時短暫排隊，等太久則改用下一個模型，
+# 避免等到 API 回傳 429 才知道配額用完
+
+import time
+
+
+class TokenBucket:
+    """每分鐘補充 rate_per_minute 的 token bucket (容量同為 rate_per_minute)"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount, now):
+        """扣除 amount 後需要等待幾秒才會回到非負 (單次超過容量則以容量計)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        # 允許扣成負數 (= 預約未來的額度)，後續請求會依此排在後面
+        self.tokens -= min(amount, self.capacity)
+
+
+class ModelRateLimiter:
+    """
+    quotas: {model_name: {"rpm": 每分鐘請求數, "tpm": 每分鐘 token 數}}，未列出的模型不限制
+    """
+
+    def __init__(self, quotas):
+        self.buckets = {}
+        for model_name, quota in (quotas or {}).items():
+            buckets = []
+            if quota.get("rpm"):
+                buckets.append((TokenBucket(quota["rpm"]), "request"))
+            if quota.get("tpm"):
+                buckets.append((TokenBucket(quota["tpm"]), "token"))
+            if buckets:
+                self.buckets[model_name] = buckets
+
+    def reserve(self, model_name, tokens, max_wait):
+        """
+        預約一次請求的額度，回傳需等待的秒數 (0 為立即可送)
+        需等待超過 max_wait 則不預約並回傳 None (呼叫端應改用下一個模型)
+        """
+        buckets = self.buckets.get(model_name)
+        if not buckets:
+            return 0.0
+        now = time.monotonic()
+        delay = max(bucket.delay_for(1 if kind == "request" else tokens, now) for bucket, kind in buckets)
+        if delay > max_wait:
+            return None
+        for bucket, kind in buckets:
+            bucket.consume(1 if kind == "request" else tokens)
+        return delay
+
+    def adjust_tokens(self, model_name, delta):
+        """回應後依實際用量修正 TPM (delta = 實際 - 預估，可為負)"""
+        for bucket, kind in self.buckets.get(model_name, ()):
+            if kind == "token":
+                bucket.tokens = min(bucket.capacity, bucket.tokens - delta)
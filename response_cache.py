@@ -0,0 +1,91 @@
+# response_cache.py
+# 模型回應快取：以 (模型, prompt, 生成參數) 的 sha256 為 key 存在 SQLite，
+# 強制重跑或發送失敗後重試時，相同的請求直接回傳上次的結果，不再重新呼叫模型
+# 有 TTL 與容量上限，超過上限時由最久沒被使用的項目開始淘汰
+
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def _serialize(value):
+    """把 contents / config 轉成穩定的字串 (pydantic 物件用 model_dump_json)"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_serialize(v) for v in value]
+    dump = getattr(value, "model_dump_json", None)
+    if dump is not None:
+        return dump(exclude_none=True)
+    return repr(value)
+
+
+def request_key(model_name, contents, config):
+    payload = json.dumps(
+        {"model": model_name, "contents": _serialize(contents), "config": _serialize(config)},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path="response_cache.db", ttl_hours=24, max_mb=20):
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                text TEXT NOT NULL,
+                usage TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+
+    def get(self, key):
+        """回傳 (text, usage)，沒有或已過期則回傳 None"""
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT text, usage, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[2] > self.ttl_seconds:
+            with self.conn:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return row[0], json.loads(row[1])
+
+    def put(self, key, model_name, text, usage):
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model_name, text, json.dumps(usage), size, now, now),
+            )
+        self.evict(now)
+
+    def evict(self, now=None):
+        """刪除過期項目，總大小仍超過上限時由最久沒被使用的開始刪"""
+        now = now or time.time()
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+
+    def close(self):
+        self.conn.close()
@@ -48,12 +48,20 @@ import discord
 import asyncio
 from datetime import datetime, timedelta, timezone
 import re
-from google import genai
 from google.genai import types
 import os
 from dotenv import load_dotenv
 from playwright.async_api import async_playwright
 from renderer import ImageGenerator
+from message_store import MessageStore
+from history_fetcher import gather_channels
+from fetch_planner import scan_shared_history, channel_history
+from message_store import datetime_from_snowflake
+from transcript import normalize_message, format_line, build_time_format, rewrite_mentions, URL_RE, NORMALIZE_SETTING_KEYS
+from transcript import TranscriptBuilder, estimate_tokens
+from llm_gateway import LLMGateway
+from model_health import ModelHealth
+from response_cache import ResponseCache
 import requests
 import io
 import urllib3
@@ -99,6 +107,13 @@ def get_settings():
         "DAYS_AGO": 1,                   # 每日金句抓取範圍  (X天前) 0為今天, 1為昨天...
         "RECENT_MSG_HOURS": 4,           # AI總結抓取範圍   (X小時內 需保留排程不準時的緩衝)
         "LINK_SCREENSHOT_HOURS": 2,      # 連結截圖抓取範圍  (X小時內 需保留排程不準時的緩衝)
+        "HISTORY_FETCH_CONCURRENCY": 4,  # 同時抓取歷史訊息的頻道數上限
+
+        # --- 本地訊息庫 (AI總結增量抓取) ---
+        "MESSAGE_STORE_MODE": 1,                   # 0=停用 (每次都完整抓取), 1=啟用 (只抓水位之後的新訊息)
+        "MESSAGE_STORE_PATH": "message_store.db",  # SQLite 檔案路徑
+        "MESSAGE_STORE_RETENTION_HOURS": 48,       # 本地訊息保留時數
+        "MESSAGE_STORE_REVALIDATE_HOURS": 2,       # 每次重新抓取最近幾小時的訊息，同步 Discord 上的編輯與刪除 (0=只抓新訊息)
 
 
 
@@ -116,6 +131,19 @@ def get_settings():
         "SHOW_ATTACHMENTS": False,       # 是否顯示附件網址
         "SIMPLIFY_LINKS": True,          # 連結簡化
         "GEMINI_TOKEN_LIMIT": 120000,    # Token 上限
+        "GEMINI_TIMEOUT_SECONDS": 180,   # 單次模型呼叫逾時秒數 (逾時視為失敗並改用下一個模型)
+        "GEMINI_MAX_RETRIES": 1,         # 逾時 / 5xx 暫時性錯誤時，同一模型的重試次數 (429 不重試，直接換模型)
+        "MODEL_HEALTH_PATH": "model_health.json",  # 模型健康狀態檔 (與 tagged_reply.py 共用，空字串為不保存)
+        "MODEL_CIRCUIT_FAILURES": 3,     # 連續失敗幾次後暫時跳過該模型
+        "MODEL_CIRCUIT_COOLDOWN_SECONDS": 300,  # 連續失敗後跳過的秒數
+        "MODEL_QUOTA_COOLDOWN_SECONDS": 600,    # 遇到 429 (配額用盡) 後跳過的秒數
+        "RESPONSE_CACHE_MODE": 1,        # 總結回應快取: 0=停用, 1=啟用 (相同 prompt 直接沿用上次結果；環境變數 BYPASS_RESPONSE_CACHE=true 可強制重新生成)
+        "RESPONSE_CACHE_PATH": "response_cache.db",  # 回應快取檔
+        "RESPONSE_CACHE_TTL_HOURS": 24,  # 快取保留時數
+        "RESPONSE_CACHE_MAX_MB": 20,     # 快取容量上限 (MB)，超過時淘汰最久未使用的項目
+        "AI_SUMMARY_MAP_REDUCE_MODE": 0,  # 0=所有頻道一次總結, 1=各頻道並行總結後串接, 2=各頻道並行總結後再由模型濃縮
+        "AI_SUMMARY_MAP_CONCURRENCY": 2,  # 分頻道總結時同時呼叫模型的數量上限 (太多容易撞到 429)
+        "GEMINI_INPUT_TOKEN_BUDGET": 100000,  # 輸入逐字稿 Token 預算 (離線估算，超過時優先刪除 Bot/附件訊息，再由最舊的開始刪)
         "GEMINI_MODEL_PRIORITY_LIST": ["gemini-3-flash-preview","gemini-3.1-flash-lite-preview","gemini-2.5-flash","gemma-4-31b-it"], # 模型列表
         # "GEMINI_MODEL_PRIORITY_LIST": ["gemma-4-31b-it"], #測試用
         "IGNORE_TOKEN": "-# 🤖",         # 截斷標記
@@ -203,6 +231,8 @@ def get_secrets():
     else:
         print("✅ 讀取 GEMINI_API_KEY")
     secrets['GEMINI_API_KEY'] = gemini_key
+    # 選填：改連到其他 Gemini API 端點 (例如本機測試用的 mock_gemini_server.py)
+    secrets['GEMINI_BASE_URL'] = os.getenv('GEMINI_BASE_URL')
 
     # 3. Source Channel IDs
     source_ids_str = os.getenv('SOURCE_CHANNEL_IDS', '')
@@ -482,30 +512,162 @@ async def send_split_message(channel, text):
     if buffer:
         await channel.send(buffer)
 
-async def run_ai_summary(client, settings, secrets):
-    mode = settings.get("AI_SUMMARY_MODE", 2)
+def open_message_store(settings):
+    """開啟本地訊息庫；整理訊息的設定變更時會清空已存的紀錄"""
+    fingerprint = json.dumps({key: settings.get(key) for key in NORMALIZE_SETTING_KEYS}, ensure_ascii=False, sort_keys=True)
+    return MessageStore(settings.get("MESSAGE_STORE_PATH", "message_store.db"),
+                        settings.get("MESSAGE_STORE_RETENTION_HOURS", 48),
+                        settings.get("MESSAGE_STORE_REVALIDATE_HOURS", 2),
+                        fingerprint)
+
+async def fetch_summary_records(client, ch, settings, after_time, store=None, snapshot=None):
+    """
+    Helper: 取得頻道在 after_time 之後的訊息紀錄；有本地訊息庫時只向 Discord 要水位之後的新訊息
+    (以及最近 MESSAGE_STORE_REVALIDATE_HOURS 小時內的訊息，用來同步編輯與刪除)
+    沒有文字與附件的訊息 (例如只有貼圖) 也會回傳 (content 為空)，供作者對照表使用
+    """
+    if store is None:
+        return [
+            normalize_message(msg, client.user.id, settings, keep_empty=True)
+            async for msg in channel_history(ch, after=after_time, snapshot=snapshot)
+        ]
+
+    after_id, covered_from = store.resume_point(ch.id, after_time)
+    new_records = []
+    last_id = after_id
+    fetched = 0
+    async for msg in channel_history(ch, after=discord.Object(id=after_id), snapshot=snapshot):
+        fetched += 1
+        last_id = max(last_id, msg.id)
+        new_records.append(normalize_message(msg, client.user.id, settings, keep_empty=True))
+
+    store.save_messages(ch.id, new_records, covered_from, last_id, after_id)
+    records = store.load_messages(ch.id, after_time)
+    print(f"      (本地訊息庫: 新抓取 {fetched} 則，時間窗內共 {len(records)} 則)")
+    return records
+
+def summary_config(settings):
+    """總結類任務共用的生成參數"""
+    return types.GenerateContentConfig(max_output_tokens=settings["GEMINI_TOKEN_LIMIT"])
+
+async def summarize_map_reduce(llm, model_list, transcript, mapping_section, settings):
+    """
+    Map-Reduce 總結：各頻道逐字稿並行分別總結 (同樣使用 ## [頻道名] 格式)，
+    再依頻道順序串接 (Mode 1)，或交給模型濃縮 (Mode 2)
+    回傳 (文字, 使用的模型, 省略訊息數)
+    """
+    base_prompt = f"請用繁體中文總結以下聊天內容\n{settings['GEMINI_SUMMARY_FORMAT']}\n\n"
+    reserved_tokens = estimate_tokens(base_prompt) + estimate_tokens(mapping_section) + 50
+
+    # Map: 每個頻道各自套用輸入預算
+    jobs = []
+    trimmed = 0
+    for section in transcript.split_sections():
+        header = section.sections[0][0]  # "--[#頻道名]"
+        ch_name = header.removeprefix("--[#").removesuffix("]")
+        lines, stats = section.build(reserved_tokens)
+        trimmed += stats["trimmed"]
+        if not lines:
+            # 對照表等固定內容已佔滿預算，此頻道沒有剩下任何訊息
+            print(f"   ⚠️ [#{ch_name}] 超出輸入預算，整個頻道被省略")
+            continue
+        jobs.append((ch_name, base_prompt + mapping_section + "\n".join(lines)))
+
+    if not jobs:
+        return None, None, trimmed
+
+    # 限制同時呼叫模型的數量，避免第一個模型一次收到所有頻道的請求而回 429
+    concurrency = settings.get("AI_SUMMARY_MAP_CONCURRENCY", 2)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def summarize_channel(ch_name, prompt):
+        async with semaphore:
+            return await llm.generate(model_list, prompt, summary_config(settings), label=f"[{ch_name}] ", cacheable=True)
+
+    print(f"   🗺️ Map-Reduce 模式：{len(jobs)} 個頻道並行總結 (同時 {concurrency} 個)")
+    results = await asyncio.gather(*(summarize_channel(ch_name, prompt) for ch_name, prompt in jobs))
+
+    parts = []
+    used_models = []
+    for (ch_name, _), result in zip(jobs, results):
+        if result.ok:
+            parts.append(result.text.strip())
+            if result.model not in used_models: used_models.append(result.model)
+        else:
+            parts.append(f"## [{ch_name}]\n⚠️ 此頻道總結失敗")
+
+    if not used_models:
+        return None, None, trimmed
+
+    # Reduce: 依頻道順序串接；Mode 2 再請模型合併濃縮 (失敗則保留串接結果)
+    stitched = "\n\n".join(parts)
+    if settings.get("AI_SUMMARY_MAP_REDUCE_MODE", 0) == 2 and len(jobs) > 1:
+        reduce_prompt = (
+            "以下是各頻道分別產生的重點摘要，請用繁體中文整理成一份完整摘要。"
+            "保留 ## [頻道名] 的段落格式，合併重複內容，不要新增原文沒有的資訊，不要多餘文字。\n\n"
+            f"{stitched}"
+        )
+        result = await llm.generate(model_list, reduce_prompt, summary_config(settings), label="[Reduce] ", cacheable=True)
+        if result.ok:
+            stitched = result.text
+            if result.model not in used_models: used_models.append(result.model)
+
+    return stitched, "、".join(used_models), trimmed
+
+# 排程任務的模式 / 頻率設定 (run_* 與共用掃描共用同一份判斷，預設值與 get_settings 一致)
+# modulo: (設定鍵, 預設值) 代表每 N 小時執行；None 代表午夜任務
+JOB_SCHEDULES = {
+    "AI Summary": {"title": "AI 總結", "mode": ("AI_SUMMARY_MODE", 2), "force_env": "FORCE_AI_SUMMARY",
+                   "modulo": ("AI_SUMMARY_SCHEDULE_MODULO", 4)},
+    "Daily Quote": {"title": "每日金句", "mode": ("DAILY_QUOTE_MODE", 1), "force_env": "FORCE_DAILY_QUOTE",
+                    "modulo": None},
+    "Daily AI Summary": {"title": "每日摘要", "mode": ("DAILY_AI_SUMMARY_MODE", 1), "force_env": "FORCE_DAILY_AI_SUMMARY",
+                         "modulo": None},
+    "Link Screenshot": {"title": "連結截圖", "mode": ("LINK_SCREENSHOT_MODE", 2), "force_env": "FORCE_LINK_SCREENSHOT",
+                        "modulo": ("LINK_SCREENSHOT_SCHEDULE_MODULO", 2)},
+    "Weather": {"title": "天氣預報", "mode": ("WEATHER_MODE", 1), "force_env": "FORCE_WEATHER_FORECAST",
+                "modulo": ("WEATHER_SCHEDULE_MODULO", 4)},
+}
+
+def check_schedule(settings, job, now):
+    """
+    Helper: 判斷排程任務此刻是否執行，回傳 (是否執行, 略過原因)
+    強制旗標 (FORCE_*) 優先；Mode 0 停用、Mode 1 定時 (允許 SCHEDULE_DELAY_TOLERANCE 小時延遲)、Mode 2 每次執行
+    """
+    schedule = JOB_SCHEDULES[job]
+    # 取得強制旗標 (相容大小寫)
+    if str(os.getenv(schedule["force_env"], "false")).lower() == "true":
+        return True, None
+
+    mode_key, default_mode = schedule["mode"]
+    mode = settings.get(mode_key, default_mode)
+    if mode == 0:
+        return False, f"⏹️ {schedule['title']}功能已停用 (Mode 0)，跳過。"
+    if mode != 1:
+        return True, None
+
+    delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
+    if schedule["modulo"] is None:
+        # 午夜任務：允許在 00:xx ~ 01:xx 執行 (應對 GH Actions 延遲)
+        if 0 <= now.hour <= delay_tolerance:
+            return True, None
+        return False, f"⏹️ [{job}] 現在 {now.strftime('%H:%M')} 非執行時段 (00:00~{delay_tolerance:02d}:59)，跳過。"
+
+    # 例如 modulo=4, delay=1, 則 0,1, 4,5, 8,9 ... 點都會執行
+    modulo_key, default_modulo = schedule["modulo"]
+    modulo = settings.get(modulo_key, default_modulo)
+    if (now.hour % modulo) <= delay_tolerance:
+        return True, None
+    return False, f"⏹️ [{job}] 現在 {now.strftime('%H:%M')} 非排程時段 (每 {modulo} 小時，允許延遲 {delay_tolerance}h)，跳過。"
+
+async def run_ai_summary(client, settings, secrets, snapshot=None):
     tz = settings["TZ"]
     now = datetime.now(tz)
-    # 取得強制旗標 (相容大小寫)
-    force_run = str(os.getenv("FORCE_AI_SUMMARY", "false")).lower() == "true"
-    
-    # Mode 2: 強制執行 (無視時間) -> 直接往下走
-    # Mode 1: 定時執行 (需檢查時間，除非有 force_run)
-    # Mode 0: 停用 (除非有 force_run)
-
-    if mode == 0 and not force_run:
-        print("⏹️ AI 總結功能已停用 (Mode 0)，跳過。")
+    due, reason = check_schedule(settings, "AI Summary", now)
+    if not due:
+        print(reason)
         return
 
-    if mode == 1 and not force_run:
-        modulo = settings.get("AI_SUMMARY_SCHEDULE_MODULO", 4)
-        delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
-        # 檢查是否在排程時段內 (允許一定程度的延遲)
-        # 例如 modulo=4, delay=1, 則 0,1, 4,5, 8,9 ... 點都會執行
-        if (now.hour % modulo) > delay_tolerance:
-            print(f"⏹️ [AI Summary] 現在 {now.strftime('%H:%M')} 非排程時段 (每 {modulo} 小時，允許延遲 {delay_tolerance}h)，跳過。")
-            return
-
     hours = settings["RECENT_MSG_HOURS"]
     print(f">>> [AI Summary] 開始執行：抓取前 {hours} 小時訊息")
     
@@ -514,19 +676,42 @@ async def run_ai_summary(client, settings, secrets):
     target_time_ago = now - timedelta(hours=hours)
     collected_output = []
     author_mapping = {} # 記錄作者用戶名與暱稱的對應關係
+    transcript = TranscriptBuilder(settings.get("GEMINI_INPUT_TOKEN_BUDGET", 100000))
+    trim_stats = None
 
     try:
         # 時間格式
-        time_fmt = ""
-        if settings["SHOW_DATE"]: time_fmt += "%Y年%m月%d日 %A "
-        time_fmt += "%H:%M"
-        if settings["SHOW_SECONDS"]: time_fmt += ":%S"
+        time_fmt = build_time_format(settings)
 
-        for channel_id in secrets["SOURCE_CHANNEL_IDS"]:
+        # 本地訊息庫 (若啟用則只向 Discord 要水位之後的新訊息)
+        store = None
+        if settings.get("MESSAGE_STORE_MODE", 1):
+            try:
+                store = open_message_store(settings)
+            except Exception as e:
+                print(f"   ⚠️ 無法開啟本地訊息庫，改為完整抓取: {e}")
+
+        async def scan_channel(channel_id):
             ch = client.get_channel(channel_id)
-            if not ch: continue
-            
+            if not ch: return None
             print(f"   正在掃描: #{ch.name}")
+            return ch, await fetch_summary_records(client, ch, settings, target_time_ago, store, snapshot)
+
+        # 並行抓取各頻道，但仍依 SOURCE_CHANNEL_IDS 順序組成逐字稿
+        failed_channel_ids = []
+        try:
+            scan_results = await gather_channels(secrets["SOURCE_CHANNEL_IDS"], scan_channel,
+                                                 settings.get("HISTORY_FETCH_CONCURRENCY", 4), failed_channel_ids)
+            if store:
+                store.prune()
+        finally:
+            # 掃描失敗也要關閉連線
+            if store:
+                store.close()
+
+        for result in scan_results:
+            if not result: continue
+            ch, records = result
             
             # 確保機器人本身在對照表中 (取得當前頻道的機器人真實暱稱)
             if ch.guild and client.user.id not in author_mapping:
@@ -534,103 +719,15 @@ async def run_ai_summary(client, settings, secrets):
                  # 雖然稍後迴圈內的訊息可能會更新此值，但預先加入可確保即使 Bot 沒發言也能被辨識
                  if bot_member:
                      author_mapping[client.user.id] = (client.user.name, bot_member.display_name)
-            channel_msgs = []
-            
-            async for msg in ch.history(after=target_time_ago, limit=None):
+            # 記錄作者資訊 (更新對照表)：沒有文字的訊息 (例如只有貼圖) 也要列入
+            for record in records:
+                author_mapping[record["author_id"]] = (record["author_name"], record["display_name"])
+            records = [r for r in records if r["content"].strip() or r["attachments"]]
+            if not records: continue
 
-                content = msg.content
-                # 截斷標記
-                ignore_token = settings.get("IGNORE_TOKEN", "> 🤖 ")
-                bot_name = settings.get("BOT_NAME", "Bot")
-                is_bot_msg = False
-
-                if ignore_token in content:
-                    content = content.split(ignore_token)[0]
-                    is_bot_msg = True
-                
-                # 額外檢查：如果是機器人自己發的訊息，一律視為 Bot 訊息
-                if msg.author.id == client.user.id:
-                    is_bot_msg = True
-                
-                # 決定顯示名稱 (用於對照表與訊息)
-                # 修正: 對照表應始終儲存真實暱稱，以便辨識
-                real_display_name = msg.author.display_name
-                
-                if is_bot_msg:
-                    transcript_display_name = bot_name
-                else:
-                    transcript_display_name = real_display_name
-
-                # 記錄作者資訊 (更新對照表)
-                author_mapping[msg.author.id] = (msg.author.name, real_display_name)
-
-                # Mentions 處理
-                if msg.mentions:
-                    for user in msg.mentions:
-                        if user.id == client.user.id:
-                            u_name = bot_name
-                        else:
-                            u_name = user.display_name[:settings["AUTHOR_NAME_LIMIT"]]
-                        content = content.replace(f"<@{user.id}>", f"@{u_name}")
-                        content = content.replace(f"<@!{user.id}>", f"@{u_name}")
-
-                # 轉發與附件處理 (Message Snapshots)
-                if hasattr(msg, 'message_snapshots') and msg.message_snapshots:
-                    for snapshot in msg.message_snapshots:
-                        s_content = getattr(snapshot, 'content', '')
-                        if s_content: content += f"[轉發內容]: {s_content}"
-                        if hasattr(snapshot, 'attachments') and snapshot.attachments:
-                            content += " (轉發附件)"
-
-                # 連結簡化
-                if settings["SIMPLIFY_LINKS"]:
-                    # Embed 標題替換
-                    if msg.embeds:
-                        for embed in msg.embeds:
-                            if embed.title:
-                                if embed.url and embed.url in content:
-                                    content = content.replace(embed.url, f"(連結 {embed.title})")
-                                elif content.strip().startswith("http"):
-                                    content = f"(連結 {embed.title})"
-                    
-                    # 剩餘連結僅留網域
-                    def domain_replacer(match):
-                        url = match.group(0)
-                        try:
-                            no_proto = url.split("://", 1)[1]
-                            return f"(連結 {no_proto.split('/', 1)[0]})"
-                        except: return url
-                    content = re.sub(r'https?://\S+', domain_replacer, content)
-
-                # 表情與時間
-                content = re.sub(r'<a?:\w+:\d+>', '(貼圖)', content)
-
-                # 長度截斷
-                if len(content) > settings.get("MAX_MSG_LENGTH", 500):
-                    content = content[:settings.get("MAX_MSG_LENGTH", 500)] + "..."
-
-                created_at_local = msg.created_at.astimezone(tz).strftime(time_fmt)
-                
-                # 決定最終顯示名稱 (一般用戶需截斷，Bot 不需)
-                if is_bot_msg:
-                    author_name = transcript_display_name
-                else:
-                    author_name = transcript_display_name[:settings["AUTHOR_NAME_LIMIT"]]
-
-                if not content.strip() and not msg.attachments: continue
-                
-                msg_line = f"{author_name}@{created_at_local}: {content}"
-                
-                # 附件顯示
-                if msg.attachments:
-                    show_att = settings["SHOW_ATTACHMENTS"]
-                    msg_line += " (附件)" if not show_att else f" (附件 {[a.url for a in msg.attachments]})"
-                
-                channel_msgs.append(msg_line)
-
-            if channel_msgs:
-                collected_output.append(f"--[#{ch.name}]")
-                collected_output.extend(channel_msgs)
+            transcript.add_section(f"--[#{ch.name}]")
+            for record in records:
+                transcript.add(record, format_line(record, settings, time_fmt))
 
         # 生成用戶對照表
         mapping_section = ""
@@ -647,10 +744,26 @@ async def run_ai_summary(client, settings, secrets):
             
             mapping_section = "[參與對話的用戶與伺服器暱稱對照表]\n" + "\n".join(mapping_lines) + "\n\n"
 
+        # 依輸入 Token 預算組裝逐字稿 (預留 prompt 模板與對照表的份量)
+        reserved_tokens = estimate_tokens(settings["GEMINI_SUMMARY_FORMAT"]) + estimate_tokens(mapping_section) + 50
+        collected_output, trim_stats = transcript.build(reserved_tokens)
+        print(f"   📏 逐字稿估計 {trim_stats['tokens']} tokens (預算 {transcript.budget})")
+        if trim_stats["trimmed"]:
+            print(f"   ✂️ 超出預算，已省略 {trim_stats['trimmed']} 則訊息 (約 {trim_stats['trimmed_tokens']} tokens)")
+
         final_messages_str = mapping_section + "\n".join(collected_output)
         # print(f"--- 收集到的訊息 ---\n{final_messages_str}\n--------------------")
         print("   訊息收集完成，準備進行 AI 總結...")
 
+        # 抓取失敗的頻道沒有列入逐字稿，在報告中標示 (避免讀者以為該頻道沒有訊息)
+        failed_note = ""
+        if failed_channel_ids:
+            failed_names = []
+            for ch_id in failed_channel_ids:
+                ch = client.get_channel(ch_id)
+                failed_names.append(f"#{ch.name}" if ch else str(ch_id))
+            failed_note = f"> -# ⚠️ 以下頻道讀取失敗，未列入本次摘要：{'、'.join(failed_names)}\n"
+
         target_ch_id = secrets["TARGET_CHANNEL_ID"]
         gemini_key = secrets["GEMINI_API_KEY"]
 
@@ -671,31 +784,17 @@ async def run_ai_summary(client, settings, secrets):
                         if "GEMINI_MODEL" in settings and "GEMINI_MODEL_PRIORITY_LIST" not in settings:
                              param_model_list = [settings["GEMINI_MODEL"]]
 
-                        generated_text = None
-                        used_model_name = None
-                        
-                        ai_client = genai.Client(api_key=gemini_key)
                         prompt = f"請用繁體中文總結以下聊天內容\n{settings['GEMINI_SUMMARY_FORMAT']}\n\n{final_messages_str}"
 
                         print(final_messages_str)
-                        
-                        for model_name in param_model_list:
-                            print(f"   🔄 嘗試模型: {model_name}...")
-                            try:
-                                response = ai_client.models.generate_content(
-                                    model=model_name,
-                                    contents=prompt,
-                                    config=types.GenerateContentConfig(max_output_tokens=settings["GEMINI_TOKEN_LIMIT"])
-                                )
-                                if response.text:
-                                    generated_text = response.text
-                                    used_model_name = model_name
-                                    print(f"   ✅ 模型 {model_name} 成功回應")
-                                    print(f"Gemini 回應:\n{response.model_dump_json(indent=2)}")
-                                    break
-                            except Exception as e:
-                                print(f"   ⚠️ 模型 {model_name} 失敗: {e}")
-                                continue
+
+                        if settings.get("AI_SUMMARY_MAP_REDUCE_MODE", 0):
+                            generated_text, used_model_name, map_trimmed = await summarize_map_reduce(
+                                client.llm, param_model_list, transcript, mapping_section, settings)
+                            trim_stats = {**trim_stats, "trimmed": map_trimmed}
+                        else:
+                            result = await client.llm.generate(param_model_list, prompt, summary_config(settings), cacheable=True)
+                            generated_text, used_model_name = result.text, result.model
 
                         if generated_text and used_model_name:
                             start_str = target_time_ago.strftime('%Y年%m月%d日 %A %H:%M')
@@ -706,12 +805,18 @@ async def run_ai_summary(client, settings, secrets):
                             else:
                                 footer_model_text = f"> -# 🤖 以上重點摘要由 Google Gemma 開放權重模型「{used_model_name}」驅動。"
 
+                            trim_note = ""
+                            if trim_stats and trim_stats["trimmed"]:
+                                trim_note = f"> -# ✂️ 訊息量過大，已省略 {trim_stats['trimmed']} 則較早或較不重要的訊息。\n"
+
                             report = (
                                 f"# ✨ {hours} 小時重點摘要出爐囉！\n"
                                 f"** 🕘 {start_str} ~ {end_str}**\n"
                                 f"\n"
                                 f"{generated_text}\n"
                                 f"{footer_model_text}\n"
+                                f"{trim_note}"
+                                f"{failed_note}"
                                 f"> -# 🤓 AI 總結內容僅供參考，敬請核實。\n"
                                 f"\n{generate_choice_solver(settings)}"
                             )
@@ -737,7 +842,8 @@ async def run_ai_summary(client, settings, secrets):
                     report = (
                         f"# ✨ {hours} 小時重點摘要出爐囉！\n"
                         f"** 🕘 {start_str} ~ {end_str}**\n\n"
-                        f"**(這段時間內沒有新訊息)**\n\n"
+                        f"**(這段時間內沒有新訊息)**\n"
+                        f"{failed_note}\n"
                         f"{generate_choice_solver(settings)}"
                     )
                     await target_ch.send(report)
@@ -748,26 +854,14 @@ async def run_ai_summary(client, settings, secrets):
     print()
 
 
-async def run_daily_quote(client, settings, secrets):
+async def run_daily_quote(client, settings, secrets, snapshot=None):
     tz = settings["TZ"]
     now = datetime.now(tz)
-    force_run = os.getenv("FORCE_DAILY_QUOTE", "false").lower() == "true"
-    mode = settings.get("DAILY_QUOTE_MODE", 1)
-
-    # Mode 0: 停用
-    if mode == 0 and not force_run:
-        print("⏹️ 每日金句功能已停用 (Mode 0)，跳過。")
+    due, reason = check_schedule(settings, "Daily Quote", now)
+    if not due:
+        print(reason)
         return
 
-    # Mode 1: 定時 (午夜)
-    if mode == 1 and not force_run:
-        delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
-        # 允許在 00:xx ~ 01:xx 執行 (應對 GH Actions 延遲)
-        is_scheduled_time = (0 <= now.hour <= delay_tolerance)
-        if not is_scheduled_time:
-            print(f"⏹️ [Daily Quote] 現在 {now.strftime('%H:%M')} 非執行時段 (00:00~{delay_tolerance:02d}:59)，跳過。")
-            return
-
     print(">>> [Daily Quote] 開始執行：每日金句")
     target_start = (now - timedelta(days=settings["DAYS_AGO"])).replace(hour=0, minute=0, second=0, microsecond=0)
     target_end = target_start + timedelta(days=1)
@@ -777,16 +871,28 @@ async def run_daily_quote(client, settings, secrets):
     best_message = None
     max_reactions = 0
 
-    for channel_id in secrets["SOURCE_CHANNEL_IDS"]:
+    async def scan_channel(channel_id):
         ch = client.get_channel(channel_id)
-        if not ch: continue
+        if not ch: return None
         print(f"   掃描: #{ch.name}")
-        async for message in ch.history(after=target_start, before=target_end, limit=None):
+        ch_best, ch_max = None, 0
+        async for message in channel_history(ch, after=target_start, before=target_end, snapshot=snapshot):
             if not message.reactions: continue
             count = sum(r.count for r in message.reactions)
-            if count > max_reactions:
-                max_reactions = count
-                best_message = message
+            if count > ch_max:
+                ch_max = count
+                ch_best = message
+        return ch_best, ch_max
+
+    # 並行掃描，再依頻道順序比較 (同分時保留較前面頻道的訊息，與逐一掃描結果相同)
+    scan_results = await gather_channels(secrets["SOURCE_CHANNEL_IDS"], scan_channel,
+                                         settings.get("HISTORY_FETCH_CONCURRENCY", 4))
+    for result in scan_results:
+        if not result: continue
+        ch_best, ch_max = result
+        if ch_max > max_reactions:
+            max_reactions = ch_max
+            best_message = ch_best
     
     target_ch = client.get_channel(secrets["TARGET_CHANNEL_ID"])
     if target_ch:
@@ -845,17 +951,9 @@ async def run_daily_quote(client, settings, secrets):
         # 0.5 準備內容 (圖片生成用 - 純淨版)
         image_clean_content = best_message.content if best_message.content else ""
         
-        # Mentions 替換 (Bot 文字訊息用)
-        if best_message.mentions:
-            for user in best_message.mentions:
-                content = content.replace(f"<@{user.id}>", f"@{user.display_name}")
-                content = content.replace(f"<@!{user.id}>", f"@{user.display_name}")
-                
-        # Mentions 替換 (圖片生成用)
-        if best_message.mentions and image_clean_content:
-            for user in best_message.mentions:
-                 image_clean_content = image_clean_content.replace(f"<@{user.id}>", f"@{user.display_name}")
-                 image_clean_content = image_clean_content.replace(f"<@!{user.id}>", f"@{user.display_name}")
+        # Mentions 替換 (Bot 文字訊息用 / 圖片生成用)
+        content = rewrite_mentions(content, best_message)
+        image_clean_content = rewrite_mentions(image_clean_content, best_message)
 
         # 額外資訊 (轉發/附件)
         extras = []
@@ -933,22 +1031,11 @@ async def run_daily_ai_summary(client, settings, secrets):
     now = datetime.now(tz)
     
     # 使用獨立的排程/強制邏輯
-    force_run = os.getenv("FORCE_DAILY_AI_SUMMARY", "false").lower() == "true"
-    mode = settings.get("DAILY_AI_SUMMARY_MODE", 1)
-
-    # Mode 0: 停用
-    if mode == 0 and not force_run:
-        print("⏹️ 每日摘要功能已停用 (Mode 0)，跳過。")
+    due, reason = check_schedule(settings, "Daily AI Summary", now)
+    if not due:
+        print(reason)
         return
 
-    # Mode 1: 定時 (午夜)
-    if mode == 1 and not force_run:
-        delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
-        is_scheduled_time = (0 <= now.hour <= delay_tolerance)
-        if not is_scheduled_time:
-            print(f"⏹️ [Daily AI Summary] 現在 {now.strftime('%H:%M')} 非執行時段，跳過。")
-            return
-
     print(">>> [Daily AI Summary] 開始執行：每日 AI 摘要彙整")
     
     # 計算昨天的日期字串 (用於比對 🕘 後的日期)
@@ -1017,10 +1104,6 @@ async def run_daily_ai_summary(client, settings, secrets):
         if "GEMINI_MODEL" in settings and "GEMINI_MODEL_PRIORITY_LIST" not in settings:
             param_model_list = [settings["GEMINI_MODEL"]]
         
-        generated_text = None
-        used_model_name = None
-        
-        ai_client = genai.Client(api_key=gemini_key)
         prompt = f"""請用繁體中文彙整以下多則「時段重點摘要」，產出一份完整的「{yesterday_str} 每日總結」。
 依照以下md格式對各頻道總結，並且適時使用換行幫助閱讀，盡量不要省略成員名(以暱稱為主)，不要多餘文字。如果有人提到何時要做什麼事，也請一併列出。必須認真思考。如果是深夜到凌晨的資料，請確認是否有混到隔天資料以免錯亂
 
@@ -1036,22 +1119,8 @@ async def run_daily_ai_summary(client, settings, secrets):
 
 {combined_text}"""
 
-        for model_name in param_model_list:
-            print(f"   🔄 嘗試模型: {model_name}...")
-            try:
-                response = ai_client.models.generate_content(
-                    model=model_name,
-                    contents=prompt,
-                    config=types.GenerateContentConfig(max_output_tokens=settings["GEMINI_TOKEN_LIMIT"])
-                )
-                if response.text:
-                    generated_text = response.text
-                    used_model_name = model_name
-                    print(f"   ✅ 模型 {model_name} 成功回應")
-                    break
-            except Exception as e:
-                print(f"   ⚠️ 模型 {model_name} 失敗: {e}")
-                continue
+        result = await client.llm.generate(param_model_list, prompt, summary_config(settings), cacheable=True)
+        generated_text, used_model_name = result.text, result.model
         
         if generated_text and used_model_name:
             if "gemini" in used_model_name.lower():
@@ -1076,25 +1145,14 @@ async def run_daily_ai_summary(client, settings, secrets):
     print()
 
 
-async def run_link_screenshot(client, settings, secrets):
-    mode = settings.get("LINK_SCREENSHOT_MODE", 2)
+async def run_link_screenshot(client, settings, secrets, snapshot=None):
     tz = settings["TZ"]
     now = datetime.now(tz)
-    # 取得強制旗標 (相容大小寫)
-    force_run = str(os.getenv("FORCE_LINK_SCREENSHOT", "false")).lower() == "true"
-    # Mode 0: 停用
-    if mode == 0 and not force_run:
-        print("⏹️ 連結截圖功能已停用 (Mode 0)，跳過。")
+    due, reason = check_schedule(settings, "Link Screenshot", now)
+    if not due:
+        print(reason)
         return
 
-    # Mode 2: 強制執行 (無視時間) -> 直接往下走
-    if mode == 1 and not force_run:
-        modulo = settings.get("LINK_SCREENSHOT_SCHEDULE_MODULO", 2)
-        delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
-        if (now.hour % modulo) > delay_tolerance:
-            print(f"⏹️ [Link Screenshot] 現在 {now.strftime('%H:%M')} 非排程時段 (每 {modulo} 小時，允許延遲 {delay_tolerance}h)，跳過。")
-            return
-
     hours = settings["LINK_SCREENSHOT_HOURS"]
     print(f">>> [Link Screenshot] 開始執行：連結截圖 ({hours} 小時內)")
     
@@ -1122,25 +1180,33 @@ async def run_link_screenshot(client, settings, secrets):
         # 收集連結
         captured_links = []
         
-        # 整合要掃描的頻道 (Source + Target Preview)
-        scan_channel_ids = set(secrets["SOURCE_CHANNEL_IDS"])
-        if secrets["TARGET_PREVIEW_ID"]:
-            scan_channel_ids.add(secrets["TARGET_PREVIEW_ID"])
+        # 整合要掃描的頻道 (Source + Target Preview，去重但保留順序)
+        scan_channel_ids = list(dict.fromkeys(secrets["SOURCE_CHANNEL_IDS"]))
+        if secrets["TARGET_PREVIEW_ID"] and secrets["TARGET_PREVIEW_ID"] not in scan_channel_ids:
+            scan_channel_ids.append(secrets["TARGET_PREVIEW_ID"])
         
         print(f"   [Debug] Source IDs: {secrets['SOURCE_CHANNEL_IDS']}")
         print(f"   [Debug] Scan Set: {scan_channel_ids}")
 
-        for channel_id in scan_channel_ids:
+        async def scan_channel(channel_id):
             ch = client.get_channel(channel_id)
-            if not ch: continue
+            if not ch: return None
             print(f"   掃描連結: #{ch.name}")
-            async for msg in ch.history(after=target_time_ago, limit=None):
+            ch_links = []
+            async for msg in channel_history(ch, after=target_time_ago, snapshot=snapshot):
                 if msg.author.id == client.user.id:
                     continue
 
-                urls = re.findall(r'(https?://\S+)', msg.content)
+                urls = URL_RE.findall(msg.content)
                 for url in urls:
-                    captured_links.append((url, msg))
+                    ch_links.append((url, msg))
+            return ch_links
+
+        scan_results = await gather_channels(scan_channel_ids, scan_channel,
+                                             settings.get("HISTORY_FETCH_CONCURRENCY", 4))
+        for ch_links in scan_results:
+            if ch_links:
+                captured_links.extend(ch_links)
         
         print(f"   共找到 {len(captured_links)} 個連結")
 
@@ -1383,25 +1449,11 @@ def get_weather_data(api_key, counties, tz):
 
 
 async def run_weather_forecast(client, settings, secrets):
-    mode = settings.get("WEATHER_MODE", 1)
-    # 取得強制旗標 (相容大小寫)
-    force_run = str(os.getenv("FORCE_WEATHER_FORECAST", "false")).lower() == "true"
-    
-    # Mode 0: 停用
-    if mode == 0 and not force_run:
-        print("⏹️ 天氣預報功能已停用 (Mode 0)，跳過。")
+    due, reason = check_schedule(settings, "Weather", datetime.now(settings["TZ"]))
+    if not due:
+        print(reason)
         return
 
-    # Mode 1: 定時
-    if mode == 1 and not force_run:
-        tz = settings["TZ"]
-        now = datetime.now(tz)
-        modulo = settings.get("WEATHER_SCHEDULE_MODULO", 4)
-        delay_tolerance = settings.get("SCHEDULE_DELAY_TOLERANCE", 1)
-        if (now.hour % modulo) > delay_tolerance:
-            print(f"⏹️ [Weather] 現在 {now.strftime('%H:%M')} 非排程時段 (每 {modulo} 小時，允許延遲 {delay_tolerance}h)，跳過。")
-            return
-
     print(">>> [Weather] 開始執行：天氣預報")
     
     if not secrets['WEATHER_KEY']:
@@ -1501,16 +1553,103 @@ async def run_weather_forecast(client, settings, secrets):
 
 
 
+async def prefetch_shared_history(client, settings, secrets):
+    """
+    共用掃描：計算本次會執行的任務所需時間窗的聯集，每個頻道只掃描一次
+    只有一個 (或沒有) 任務需要讀取來源頻道時回傳 None，由任務自行抓取
+    """
+    tz = settings["TZ"]
+    now = datetime.now(tz)
+    requests_plan = []  # [(channel_id, after, before), ...]
+    due_jobs = []
+
+    if check_schedule(settings, "AI Summary", now)[0]:
+        due_jobs.append("AI Summary")
+        after = now - timedelta(hours=settings["RECENT_MSG_HOURS"])
+        store = None
+        if settings.get("MESSAGE_STORE_MODE", 1):
+            try:
+                store = open_message_store(settings)
+            except Exception as e:
+                print(f"   ⚠️ 無法開啟本地訊息庫: {e}")
+        for channel_id in secrets["SOURCE_CHANNEL_IDS"]:
+            ch_after = after
+            if store:
+                # 有本地訊息庫時，AI 總結只需要水位之後的訊息
+                ch_after = datetime_from_snowflake(store.resume_point(channel_id, after)[0])
+            requests_plan.append((channel_id, ch_after, None))
+        if store:
+            store.close()
+
+    if check_schedule(settings, "Daily Quote", now)[0]:
+        due_jobs.append("Daily Quote")
+        target_start = (now - timedelta(days=settings["DAYS_AGO"])).replace(hour=0, minute=0, second=0, microsecond=0)
+        target_end = target_start + timedelta(days=1)
+        for channel_id in secrets["SOURCE_CHANNEL_IDS"]:
+            requests_plan.append((channel_id, target_start, target_end))
+
+    if check_schedule(settings, "Link Screenshot", now)[0]:
+        due_jobs.append("Link Screenshot")
+        after = now - timedelta(hours=settings["LINK_SCREENSHOT_HOURS"])
+        scan_channel_ids = list(secrets["SOURCE_CHANNEL_IDS"])
+        if secrets["TARGET_PREVIEW_ID"]:
+            scan_channel_ids.append(secrets["TARGET_PREVIEW_ID"])
+        for channel_id in scan_channel_ids:
+            requests_plan.append((channel_id, after, None))
+
+    if len(due_jobs) < 2:
+        return None
+
+    print(f">>> [Shared Scan] {', '.join(due_jobs)} 共用一次歷史掃描")
+    try:
+        return await scan_shared_history(client, requests_plan, settings.get("HISTORY_FETCH_CONCURRENCY", 4))
+    except Exception as e:
+        print(f"❌ 共用掃描失敗，改由各任務自行抓取: {e}")
+        return None
+    finally:
+        print()
+
 # ==========================================
 #              主程式 (MAIN)
 # ==========================================
 
+def build_model_health(settings):
+    """依設定建立模型健康狀態追蹤 (斷路器)"""
+    return ModelHealth(
+        settings.get("MODEL_HEALTH_PATH", "model_health.json"),
+        failure_threshold=settings.get("MODEL_CIRCUIT_FAILURES", 3),
+        cooldown_seconds=settings.get("MODEL_CIRCUIT_COOLDOWN_SECONDS", 300),
+        quota_cooldown_seconds=settings.get("MODEL_QUOTA_COOLDOWN_SECONDS", 600),
+    )
+
+def build_response_cache(settings):
+    """依設定建立總結回應快取 (RESPONSE_CACHE_MODE 0 則回傳 None)"""
+    if not settings.get("RESPONSE_CACHE_MODE", 1):
+        return None
+    return ResponseCache(
+        settings.get("RESPONSE_CACHE_PATH", "response_cache.db"),
+        ttl_hours=settings.get("RESPONSE_CACHE_TTL_HOURS", 24),
+        max_mb=settings.get("RESPONSE_CACHE_MAX_MB", 20),
+    )
+
 class MyClient(discord.Client):
     def __init__(self, settings, secrets, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.settings = settings
         self.secrets = secrets
         self._has_run = False # 防止 on_ready 重複觸發
+        # 共用的 LLM 入口 (整個行程共用一個 client 與連線)
+        self.llm = None
+        if secrets["GEMINI_API_KEY"]:
+            self.llm = LLMGateway(
+                secrets["GEMINI_API_KEY"],
+                timeout=settings.get("GEMINI_TIMEOUT_SECONDS", 180),
+                retries=settings.get("GEMINI_MAX_RETRIES", 1),
+                health=build_model_health(settings),
+                cache=build_response_cache(settings),
+                cache_bypass=str(os.getenv("BYPASS_RESPONSE_CACHE", "false")).lower() == "true",
+                base_url=secrets.get("GEMINI_BASE_URL"),
+            )
 
     async def on_ready(self):
         if self._has_run:
@@ -1521,22 +1660,32 @@ class MyClient(discord.Client):
         print(f'✅ Bot 已登入：{self.user}')
         print('-------------------------------------------')
 
+        # 0. 共用歷史掃描 (多個任務同時執行時，每個頻道只掃描一次)
+        snapshot = await prefetch_shared_history(self, self.settings, self.secrets)
+
         # 1. 執行 AI 總結
-        await run_ai_summary(self, self.settings, self.secrets)
+        await run_ai_summary(self, self.settings, self.secrets, snapshot=snapshot)
 
         # 2. 執行 每日摘要彙整 (放在金句之後)
         await run_daily_ai_summary(self, self.settings, self.secrets)
 
         # 3. 執行 每日金句
-        await run_daily_quote(self, self.settings, self.secrets)
+        await run_daily_quote(self, self.settings, self.secrets, snapshot=snapshot)
 
         # 4. 執行 天氣預報
         await run_weather_forecast(self, self.settings, self.secrets)
 
         # 5. 執行 連結截圖
-        await run_link_screenshot(self, self.settings, self.secrets)
+        await run_link_screenshot(self, self.settings, self.secrets, snapshot=snapshot)
 
         
+        if self.llm:
+            if self.llm.usage_totals:
+                print(f"📊 本次模型用量:\n{self.llm.usage_summary()}")
+            await self.llm.aclose()
+            if self.llm.cache:
+                self.llm.cache.close()
+
         print('-------------------------------------------')
         print("🎉 所有排程執行完畢，Bot 關閉。")
         await self.close()
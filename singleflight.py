@@ -0,0 +1,39 @@
+# singleflight.py
+# 相同請求合併：同一個 key 的請求還在進行中時，後到的呼叫直接等待同一個結果，不再重複送出
+# (例如多人同時對同一張圖 /辨識圖片、或重試時上一次相同的呼叫還沒結束)
+
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}  # key -> [task, 等待中的呼叫數]
+        self.shared = 0  # 合併掉的呼叫次數 (統計用)
+
+    def in_flight(self, key):
+        return key in self.calls
+
+    async def do(self, key, coro_fn):
+        """
+        執行 coro_fn() 並回傳結果；相同 key 已在進行中則共用該次結果 (包含例外)
+        個別呼叫端被取消不影響其他等待者；所有等待者都取消時才取消底層的呼叫
+        """
+        call = self.calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(coro_fn())
+            call = self.calls[key] = [task, 0]
+
+            def forget(_):
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            task.add_done_callback(forget)
+        else:
+            self.shared += 1
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                call[0].cancel()
@@ -30,13 +30,22 @@ def check_requirements():
 check_requirements()
 
 import discord
+import asyncio
+import json
 import os
-import re
-from datetime import datetime, timedelta, timezone
-from google import genai
+import time
+from datetime import timedelta, timezone
 from google.genai import types
 
 from dotenv import load_dotenv
+from transcript import transcript_name, build_time_format
+from transcript import TranscriptBuilder, estimate_tokens
+from llm_gateway import LLMGateway
+from model_health import ModelHealth
+from rate_limiter import ModelRateLimiter
+from context_cache import ContextCacheRegistry
+from channel_buffer import MessageBuffer
+from line_cache import LineCache
 
 def get_settings():
     """回傳使用者偏好的設定參數"""
@@ -53,10 +62,17 @@ def get_settings():
         "IGNORE_TOKEN": "-# 🤖",             # 截斷標記
         "ENABLE_EXEC_COMMAND": True,      # 是否啟用關鍵字執行指令
         "EXEC_COMMAND_KEYWORD": "update_bot",     # 觸發執行的關鍵字
+        "UPDATE_MARKER_PATH": "pending_update.json",  # 更新重啟前記錄「誰在哪個頻道要求更新」，重啟後據此回報
+        "UPDATE_MODE": "restart",         # restart=斷線後 git pull 並重啟 (會離線一段時間)；handover=背景啟動新行程，就緒後才交接 (不中斷服務)
+        "ACTIVE_PID_PATH": "active_bot.pid",  # handover: 目前負責回應的行程 PID (新行程就緒時寫入)
+        "HANDOVER_READY_TIMEOUT_SECONDS": 120,  # handover: 新行程需在幾秒內就緒，否則放棄交接、由舊行程繼續服務
+        "HANDOVER_DRAIN_TIMEOUT_SECONDS": 60,   # handover: 交接後舊行程最多等幾秒讓進行中的回覆完成
+        # 版面依「穩定 -> 變動」排列：人設規則 (固定) -> 對話歷史 (大多與上次相同) -> 當前任務 (每次不同)
+        # 固定的開頭才能被模型端的快取 (隱式 / Context Cache) 重複使用，請勿在 {context_str} 之前放入會變動的欄位
         "TAGGED_REPLY_PROMPT_TEMPLATE": """你是這個群組的機器人。
 
 【能力範圍】
-- 只能看到這個頻道最新 {msg_limit} 則對話，無法存取其他頻道或圖片
+- 只能看到這個頻道的近期對話，無法存取其他頻道或圖片
 - 一般知識可以聊；時效性資訊（股票、新產品、即時新聞）不回答
 
 【回覆風格】
@@ -67,15 +83,15 @@ def get_settings():
 【當用戶情緒低落時】
 先給同理心，再做其他事，用戶叫你做什麼就做什麼
 
-{think_on_not}
+以下是近期對話歷史（僅供背景參考）：
+{context_str}
+（以上為此頻道最新 {msg_limit} 則對話）
 
 ━━━━━━━━━━━━━━━━━━━━
 ⚡ 當前任務（最高優先，忽略一切歷史衝突）
 {u_name}：{content_clean}
 ━━━━━━━━━━━━━━━━━━━━
-
-以下是近期對話歷史（僅供背景參考）：
-{context_str}""",
+{think_on_not}""",
         "MODEL_PRIORITY_LIST": ["gemma-4-31b-it"],
         "DEFAULT_TOKEN_LIMIT": 75000,
         "SMARTER_MODE_KEYWORD": "/聰明模型", 
@@ -83,6 +99,36 @@ def get_settings():
         "SMARTER_TOKEN_LIMIT": 120000,
         "SMARTER_TOTAL_MSG_LIMIT": 150,
         "SMARTER_MAX_MSG_LENGTH": 150,
+        "GEMINI_TIMEOUT_SECONDS": 60,     # 單次模型呼叫逾時秒數 (逾時改用下一個模型)
+        "GEMINI_MAX_RETRIES": 0,          # 逾時 / 5xx 時同一模型的重試次數 (即時回覆以換模型為主)
+        "MODEL_HEALTH_PATH": "model_health.json",  # 模型健康狀態檔 (與 server.py 共用，空字串為不保存)
+        "MODEL_CIRCUIT_FAILURES": 3,      # 連續失敗幾次後暫時跳過該模型
+        "MODEL_CIRCUIT_COOLDOWN_SECONDS": 300,  # 連續失敗後跳過的秒數
+        "MODEL_QUOTA_COOLDOWN_SECONDS": 600,    # 遇到 429 (配額用盡) 後跳過的秒數
+        "MODEL_QUOTAS": {                 # 本機速率限制 (每分鐘請求數 / 輸入 token 數)，請依 AI Studio 方案調整，未列出的模型不限制
+            "gemma-4-31b-it": {"rpm": 30, "tpm": 15000},
+            "gemini-3.1-flash-lite": {"rpm": 15, "tpm": 250000},
+            "gemini-2.5-flash": {"rpm": 10, "tpm": 250000},
+        },
+        "RATE_LIMIT_MAX_WAIT_SECONDS": 3, # 額度不足時最多排隊幾秒，超過則改用下一個模型
+        "MODEL_INPUT_TOKEN_BUDGETS": {    # 各模型的輸入 token 預算 (超出時裁切對話歷史)，未列出的模型使用 DEFAULT_INPUT_TOKEN_BUDGET
+            "gemma-4-31b-it": 8000,
+            "gemini-3.1-flash-lite": 60000,
+            "gemini-2.5-flash": 60000,
+        },
+        "DEFAULT_INPUT_TOKEN_BUDGET": 8000,
+        "TOKEN_COUNT_CHECK": 0,           # 1=送出前以 API (count_tokens) 核對實際 token 數 (結果會快取)，0=只用離線估算
+        "CONTEXT_CACHE_MODE": 0,          # 1=把人設與對話歷史建成 Gemini Context Cache，同頻道連續提問只送新增部分 (Gemma 不支援，自動略過)
+        "CONTEXT_CACHE_TTL_SECONDS": 600, # Context Cache 存活秒數 (使用中會自動延長；快取依存放時間計費)
+        "CONTEXT_CACHE_MIN_TOKENS": 2048, # 前綴低於此 token 數不建立快取 (API 有最小長度限制)
+        "HEDGE_MODE": 0,                  # 1=第一個模型超過延遲門檻仍未回應時，同時向下一個模型送出請求，取先回來的結果 (會多花額度)
+        "HEDGE_PERCENTILE": 90,           # 延遲門檻：該模型最近成功延遲的第幾百分位
+        "HEDGE_DEFAULT_DELAY_SECONDS": 8, # 延遲樣本不足時使用的門檻秒數
+        "HEDGE_MIN_SAMPLES": 20,          # 至少累積幾筆延遲樣本才改用百分位門檻
+        "STREAM_MODE": 0,                 # 1=串流回覆：收到第一段文字就先回覆，之後定時編輯訊息補上後續內容 (啟用時不使用 Hedging)
+        "STREAM_EDIT_INTERVAL_SECONDS": 1.2,  # 串流時編輯訊息的最短間隔秒數 (避免撞到 Discord 速率限制)
+        "CHANNEL_BUFFER_SIZE": 200,       # 每個頻道在記憶體保留的最近訊息數 (應 >= SMARTER_TOTAL_MSG_LIMIT)，0=停用，每次都呼叫 history()
+        "LINE_CACHE_SIZE": 2000,          # 已整理好的逐字稿行快取則數 (訊息編輯 / 刪除、用戶改名時自動失效)，0=停用
     }
 
 def get_secrets():
@@ -105,28 +151,147 @@ def get_secrets():
         print("⚠️ 警告: 未讀取到 GEMINI_API_KEY")
     secrets['GEMINI_API_KEY'] = gemini_key
 
+    # 3. 選填：改連到其他 Gemini API 端點 (例如本機測試用的 mock_gemini_server.py)
+    secrets['GEMINI_BASE_URL'] = os.getenv('GEMINI_BASE_URL')
+
     return secrets
 
 # 設定標準輸出緩衝
 sys.stdout.reconfigure(line_buffering=True)
 
+DISCORD_MESSAGE_LIMIT = 2000
+# 交接更新時傳給新行程的環境變數 (標記為交接啟動，接手前不回應)
+HANDOVER_ENV = "TAGGED_REPLY_HANDOVER"
+
+
+def detect_supervisor():
+    """
+    偵測行程管理工具 (pm2 / systemd / Docker)，回傳名稱或 None
+    這類環境由管理工具負責重啟：handover 啟動的新行程不受管理，舊行程結束後還會被當成當機再啟動一份
+    """
+    if "pm_id" in os.environ:
+        return "pm2"
+    if os.environ.get("INVOCATION_ID"):
+        return "systemd"
+    if os.path.exists("/.dockerenv") or os.getpid() == 1:
+        return "Docker"
+    return None
+
+class StreamingReply:
+    """
+    串流回覆：收到第一段文字就先回覆，之後依固定間隔編輯訊息 (避免撞到 Discord 編輯速率限制)
+    超過 2000 字時定稿目前這則，剩下的內容接續發在新訊息；footer 在最後才附上
+    """
+
+    def __init__(self, message, edit_interval=1.2):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.sent = []          # 已發出的 Discord 訊息 (最後一則為目前編輯中的訊息)
+        self.offset = 0         # 目前訊息內容在全文中的起點
+        self.shown = ""         # 目前訊息最後一次顯示的內容
+        self.last_edit = 0.0
+
+    async def _show(self, content):
+        if not self.sent:
+            self.sent.append(await self.message.reply(content, allowed_mentions=discord.AllowedMentions.none()))
+        elif content != self.shown:
+            await self.sent[-1].edit(content=content, allowed_mentions=discord.AllowedMentions.none())
+        self.shown = content
+        self.last_edit = time.monotonic()
+
+    async def _roll_over(self, text):
+        """目前這則放不下時，在 2000 字內最後一個換行處定稿，剩下的改發新訊息"""
+        while len(text) - self.offset > DISCORD_MESSAGE_LIMIT:
+            page = text[self.offset:self.offset + DISCORD_MESSAGE_LIMIT]
+            cut = page.rfind("\n")
+            if cut < DISCORD_MESSAGE_LIMIT // 2:
+                cut = DISCORD_MESSAGE_LIMIT
+            await self._show(page[:cut])
+            self.offset += cut
+            rest = text[self.offset:self.offset + DISCORD_MESSAGE_LIMIT].lstrip("\n") or "…"
+            self.sent.append(await self.message.channel.send(rest, allowed_mentions=discord.AllowedMentions.none()))
+            self.shown = rest
+            self.last_edit = time.monotonic()
+
+    async def update(self, text):
+        """串流途中每收到一段文字呼叫一次 (text 為目前累積的全文)"""
+        await self._roll_over(text)
+        if self.sent and time.monotonic() - self.last_edit < self.edit_interval:
+            return
+        await self._show(text[self.offset:].lstrip("\n") or "…")
+
+    async def finish(self, text, footer=""):
+        """串流結束：顯示完整內容並附上 footer (放不下時 footer 另發一則)"""
+        await self._roll_over(text)
+        body = text[self.offset:].lstrip("\n")
+        if len(body) + len(footer) <= DISCORD_MESSAGE_LIMIT:
+            await self._show(body + footer)
+            return
+        await self._show(body)
+        if footer:
+            await self.message.channel.send(footer.lstrip("\n"), allowed_mentions=discord.AllowedMentions.none())
+
 class TaggedResponseBot(discord.Client):
     def __init__(self, settings, secrets, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.settings = settings
         self.secrets = secrets
-        self.genai_client = None
+        self.llm = None
         
-        # 初始化 GenAI Client
+        # 初始化共用 LLM 入口 (長駐 client，連線在多次回覆間重複使用)
         if self.secrets['GEMINI_API_KEY']:
             try:
-                self.genai_client = genai.Client(api_key=self.secrets['GEMINI_API_KEY'])
+                self.llm = LLMGateway(
+                    self.secrets['GEMINI_API_KEY'],
+                    timeout=self.settings.get("GEMINI_TIMEOUT_SECONDS", 60),
+                    retries=self.settings.get("GEMINI_MAX_RETRIES", 0),
+                    health=ModelHealth(
+                        self.settings.get("MODEL_HEALTH_PATH", "model_health.json"),
+                        failure_threshold=self.settings.get("MODEL_CIRCUIT_FAILURES", 3),
+                        cooldown_seconds=self.settings.get("MODEL_CIRCUIT_COOLDOWN_SECONDS", 300),
+                        quota_cooldown_seconds=self.settings.get("MODEL_QUOTA_COOLDOWN_SECONDS", 600),
+                    ),
+                    limiter=ModelRateLimiter(self.settings.get("MODEL_QUOTAS", {})),
+                    max_queue_wait=self.settings.get("RATE_LIMIT_MAX_WAIT_SECONDS", 3),
+                    hedge_percentile=self.settings.get("HEDGE_PERCENTILE", 90),
+                    hedge_default_delay=self.settings.get("HEDGE_DEFAULT_DELAY_SECONDS", 8),
+                    hedge_min_samples=self.settings.get("HEDGE_MIN_SAMPLES", 20),
+                    base_url=self.secrets.get('GEMINI_BASE_URL'),
+                )
                 print("✅ GenAI Client 初始化成功")
             except Exception as e:
                 print(f"❌ GenAI Client 初始化失敗: {e}")
         else:
             print("⚠️ 警告: 未設定 GEMINI_API_KEY")
 
+        # Context Cache (選用)：同一頻道連續提問時沿用人設與對話歷史的快取
+        self.context_cache = None
+        if self.llm and self.settings.get("CONTEXT_CACHE_MODE", 0):
+            self.context_cache = ContextCacheRegistry(
+                self.llm.client,
+                ttl_seconds=self.settings.get("CONTEXT_CACHE_TTL_SECONDS", 600),
+                min_tokens=self.settings.get("CONTEXT_CACHE_MIN_TOKENS", 2048),
+            )
+
+        # 各頻道最近訊息的記憶體緩衝 (第一次使用時暖機，之後由訊息事件更新)
+        self.message_buffer = MessageBuffer(self.settings.get("CHANNEL_BUFFER_SIZE", 200))
+        # 已整理好的逐字稿行 (每次只需整理新訊息)
+        self.line_cache = LineCache(self.settings.get("LINE_CACHE_SIZE", 2000))
+
+        # 不中斷更新 (UPDATE_MODE=handover) 的狀態
+        self.in_flight = 0            # 處理中的訊息數 (交接後等這些完成才結束)
+        self.handover_child = None    # 交接中的新行程 (subprocess.Popen)
+        self.handover_task = None
+        self.retired = False          # 已交接給新行程，不再回應
+        self.update_mode = self.settings.get("UPDATE_MODE", "restart")
+        if self.update_mode == "handover":
+            supervisor = detect_supervisor()
+            if supervisor:
+                print(f"⚠️ 偵測到由 {supervisor} 管理，UPDATE_MODE=handover 的新行程會脫離管理，改用 restart 模式更新")
+                self.update_mode = "restart"
+        # 由交接啟動的新行程：寫入 PID 檔 (舊行程停止回應) 之前不回應，避免新舊行程重複回覆
+        self.awaiting_handover = os.environ.pop(HANDOVER_ENV, None) is not None
+
         self.model_priority_list = self.settings.get("MODEL_PRIORITY_LIST", ["gemini-3.1-flash-lite","gemma-4-31b-it"])
         self.ignore_after_token = self.settings.get("IGNORE_TOKEN", "-# 🤖")
 
@@ -134,8 +299,15 @@ class TaggedResponseBot(discord.Client):
         print('-------------------------------------------')
         print(f'✅ Bot 已登入 (Tagged Response Mode): {self.user}')
         print(f'🤖 模型優先順序: {self.model_priority_list}')
+        if self.llm and self.llm.health:
+            smarter_list = self.settings.get("SMARTER_MODEL_PRIORITY_LIST", [])
+            all_models = self.model_priority_list + [m for m in smarter_list if m not in self.model_priority_list]
+            print(f'🩺 模型健康狀態:\n{self.llm.health.describe(all_models)}')
         print('-------------------------------------------')
 
+        # 重新連線 (非 RESUME) 期間可能漏掉訊息事件，讓各頻道的緩衝重新暖機
+        self.message_buffer.clear()
+
         # === 啟動系統資訊推播 ===
         if not hasattr(self, 'hello_run'):
             self.hello_run = True
@@ -150,79 +322,279 @@ class TaggedResponseBot(discord.Client):
         # 🚀 啟動檢查：檢查是否是從 OTA 更新重啟回來的
         if not hasattr(self, 'startup_checked'):
             self.startup_checked = True
+            # 宣告由此行程負責回應 (若是交接啟動的新行程，舊行程看到後就會停止回應並結束)
+            if self.write_active_pid():
+                self.awaiting_handover = False
             await self.check_ota_status_on_startup()
 
+    def write_update_marker(self, message):
+        """重啟前記錄發出更新指令的頻道 / 訊息與目前的 commit，重啟後由 check_ota_status_on_startup 讀取"""
+        try:
+            commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+        except Exception:
+            commit = None
+        marker = {
+            "channel_id": message.channel.id,
+            "message_id": message.id,
+            "commit": commit,
+            "requested_at": time.time(),
+        }
+        path = self.settings.get("UPDATE_MARKER_PATH", "pending_update.json")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(marker, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ 寫入更新標記失敗 (重啟後不會回報): {e}")
+
+    def remove_update_marker(self):
+        """放棄更新時刪除標記檔 (目前的行程繼續服務，不需要回報)"""
+        try:
+            os.remove(self.settings.get("UPDATE_MARKER_PATH", "pending_update.json"))
+        except OSError:
+            pass
+
+    def read_active_pid(self):
+        try:
+            with open(self.settings.get("ACTIVE_PID_PATH", "active_bot.pid"), encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def write_active_pid(self):
+        path = self.settings.get("ACTIVE_PID_PATH", "active_bot.pid")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(str(os.getpid()))
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            print(f"⚠️ 寫入 PID 檔失敗: {e}")
+            return False
+
+    def is_active(self):
+        """此行程是否應回應訊息 (交接期間以 PID 檔判斷，新行程就緒後舊行程立即停止回應)"""
+        if self.retired:
+            return False
+        if self.awaiting_handover:
+            return self.read_active_pid() == os.getpid()
+        if self.handover_child is None:
+            return True
+        return self.read_active_pid() != self.handover_child.pid
+
+    async def handover_update(self, message):
+        """
+        不中斷更新：背景 git pull -> 啟動新行程 (完成 import、初始化、連上 Gateway) ->
+        新行程就緒 (寫入 PID 檔) 後停止回應新訊息 -> 等進行中的回覆完成 -> 結束舊行程
+        新行程啟動失敗或逾時則放棄交接，由舊行程繼續服務
+        """
+        try:
+            # 先記錄 pull 之前的 commit，新行程才能判斷是否真的有更新
+            self.write_update_marker(message)
+            print("🔄 [交接] 執行 git pull (背景)...")
+            pull = await asyncio.create_subprocess_exec("git", "pull")
+            if await pull.wait() != 0:
+                raise RuntimeError(f"git pull 失敗 (exit code {pull.returncode})")
+
+            print("🔄 [交接] 啟動新行程...")
+            self.handover_child = subprocess.Popen([sys.executable] + sys.argv, env={**os.environ, HANDOVER_ENV: "1"})
+        except Exception as e:
+            print(f"❌ [交接] 更新失敗，由目前的行程繼續服務: {e}")
+            self.remove_update_marker()
+            await message.reply(f"❌ 更新失敗：{e}，目前的版本會繼續運作。")
+            return
+
+        child = self.handover_child
+        timeout = self.settings.get("HANDOVER_READY_TIMEOUT_SECONDS", 120)
+        deadline = time.monotonic() + timeout
+        failure = None
+        while self.read_active_pid() != child.pid:
+            if child.poll() is not None:
+                failure = f"新行程啟動失敗 (exit code {child.returncode})"
+                break
+            if time.monotonic() > deadline:
+                failure = f"新行程 {timeout}s 內未就緒"
+                child.terminate()
+                break
+            await asyncio.sleep(1)
+
+        if failure:
+            print(f"❌ [交接] {failure}，由目前的行程繼續服務")
+            self.handover_child = None
+            self.remove_update_marker()
+            await message.reply(f"❌ 更新失敗：{failure}，目前的版本會繼續運作。")
+            return
+
+        # 新行程已接手：不再回應新訊息，等進行中的回覆完成後結束
+        self.retired = True
+        drain_timeout = self.settings.get("HANDOVER_DRAIN_TIMEOUT_SECONDS", 60)
+        print(f"✅ [交接] 新行程 (PID {child.pid}) 已接手，等待 {self.in_flight} 則進行中的回覆完成...")
+        deadline = time.monotonic() + drain_timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if self.in_flight:
+            print(f"⚠️ [交接] {drain_timeout}s 內仍有 {self.in_flight} 則回覆未完成，直接結束")
+        print("👋 [交接] 舊行程結束")
+        await self.close()
+
     async def check_ota_status_on_startup(self):
-        """搜尋近期的訊息，找出最後發出更新指令的頻道並回報"""
-        keyword = self.settings.get("EXEC_COMMAND_KEYWORD", "update_bot")
-        # 設定 2 分鐘的時間範圍
-        time_limit = datetime.now(timezone.utc) - timedelta(minutes=2)
-        print(f"🔍 正在檢查近期是否有頻道在等待更新回報 (關鍵字: {keyword})...")
-        
-        target_message = None
+        """讀取更新前留下的標記檔，向發出更新指令的頻道回報 (沒有標記檔則略過)"""
+        path = self.settings.get("UPDATE_MARKER_PATH", "pending_update.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                marker = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 更新標記檔無法讀取，略過回報: {e}")
+            marker = None
+        # 先刪除再回報：就算回報失敗也不會在下次啟動時重複發送
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if not marker:
+            return
 
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                perms = channel.permissions_for(guild.me)
-                if not perms.send_messages or not perms.read_message_history:
-                    continue
+        try:
+            channel = self.get_channel(marker["channel_id"]) or await self.fetch_channel(marker["channel_id"])
+        except Exception as e:
+            print(f"⚠️ 找不到發出更新指令的頻道，略過回報: {e}")
+            return
+        print(f"✅ 偵測到更新標記 (#{channel})，發送回報...")
 
-                try:
-                    # 抓取x分鐘內的歷史紀錄
-                    async for msg in channel.history(after=time_limit, limit=20):
-                        is_triggered = self.user in msg.mentions
-                        content_clean = msg.content.replace(f'<@{self.user.id}>', '').replace(f'<@!{self.user.id}>', '').strip()
-                        
-                        if is_triggered and keyword in content_clean:
-                            # 找出全域最新的一則
-                            if not target_message or msg.created_at > target_message.created_at:
-                                target_message = msg
-                except:
-                    continue
-        
-        if target_message:
-            print(f"✅ 在 #{target_message.channel.name} 偵測到最後一次更新指令，發送回報...")
-            try:
-                commit_msg = subprocess.check_output(["git", "log", "-1", "--pretty=%B"], text=True).strip()
-                commit_time = subprocess.check_output(["git", "log", "-1", "--date=format:%Y-%m-%d %H:%M:%S %z", "--pretty=%cd"], text=True).strip()
-            except Exception as e:
-                commit_msg = "無法取得更新內容"
-                commit_time = "未知"
-                print(f"⚠️ 取得 Git 資訊失敗: {e}")
-
-            welcome_msg = (
-                f"# 嗨，我回來了！\n"
-                f"來看看我有什麼新功能吧\n"
-                f"### 最新功能：\n{commit_msg}\n"
-                f"### 更新時間：\n{commit_time}\n"
-            )
-            await target_message.channel.send(welcome_msg)
+        try:
+            commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+            commit_msg = subprocess.check_output(["git", "log", "-1", "--pretty=%B"], text=True).strip()
+            commit_time = subprocess.check_output(["git", "log", "-1", "--date=format:%Y-%m-%d %H:%M:%S %z", "--pretty=%cd"], text=True).strip()
+        except Exception as e:
+            commit = None
+            commit_msg = "無法取得更新內容"
+            commit_time = "未知"
+            print(f"⚠️ 取得 Git 資訊失敗: {e}")
+
+        welcome_msg = (
+            f"# 嗨，我回來了！\n"
+            f"來看看我有什麼新功能吧\n"
+            f"### 最新功能：\n{commit_msg}\n"
+            f"### 更新時間：\n{commit_time}\n"
+        )
+        if commit and commit == marker.get("commit"):
+            welcome_msg += "> -# 🤖 沒有可用的更新，已重新啟動目前的版本。\n"
+        try:
+            await channel.send(welcome_msg)
+        except Exception as e:
+            print(f"⚠️ 發送更新回報失敗: {e}")
+
+    async def on_message_edit(self, before, after):
+        # 已在 discord.py 快取中的訊息被編輯
+        self.message_buffer.replace(after)
+        self.line_cache.invalidate_message(after.id)
+
+    async def on_raw_message_edit(self, payload):
+        # 不在 discord.py 快取中的訊息 (例如暖機時由 history() 取得的) 只會收到 raw 事件
+        if payload.cached_message is not None:
+            return  # 交給 on_message_edit
+        self.line_cache.invalidate_message(payload.message_id)
+        if not self.message_buffer.contains(payload.channel_id, payload.message_id):
+            return
+        message = getattr(payload, "message", None)  # discord.py 2.4+ 才有
+        try:
+            if message is None:
+                channel = self.get_channel(payload.channel_id)
+                message = await channel.fetch_message(payload.message_id)
+            self.message_buffer.replace(message)
+        except Exception as e:
+            print(f"   ⚠️ 無法取得被編輯的訊息，自緩衝區移除: {e}")
+            self.message_buffer.remove(payload.channel_id, [payload.message_id])
+
+    async def on_raw_message_delete(self, payload):
+        self.message_buffer.remove(payload.channel_id, [payload.message_id])
+        self.line_cache.invalidate_message(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        self.message_buffer.remove(payload.channel_id, payload.message_ids)
+        for message_id in payload.message_ids:
+            self.line_cache.invalidate_message(message_id)
+
+    async def on_member_update(self, before, after):
+        # 伺服器暱稱變更：作者或被提及者為此成員的逐字稿行需重新整理
+        if before.display_name != after.display_name:
+            self.message_buffer.refresh_member(after)
+            self.line_cache.invalidate_user(after.id)
+
+    async def on_user_update(self, before, after):
+        # 使用者名稱 / 全域顯示名稱變更 (沒有伺服器暱稱時會顯示全域名稱)
+        if before.name != after.name or before.display_name != after.display_name:
+            self.line_cache.invalidate_user(after.id)
+
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            self.line_cache.clear()  # 身分組提及會顯示名稱 (少見，直接全部重新整理)
+
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            self.line_cache.clear()  # 頻道提及會顯示名稱
+
+    async def resolve_reference(self, message):
+        """
+        取得被回覆的訊息 (每則觸發訊息只解析一次)：
+        優先使用 Gateway 附帶的 reference.resolved，其次是頻道緩衝，最後才呼叫 API (僅限同頻道)
+        找不到、已刪除或跨頻道回覆則回傳 None
+        """
+        reference = message.reference
+        if not reference or not reference.message_id:
+            return None
+        if isinstance(reference.resolved, discord.Message):
+            return reference.resolved
+        if isinstance(reference.resolved, discord.DeletedReferencedMessage):
+            return None
+        if reference.channel_id != message.channel.id:
+            return None
+        cached = self.message_buffer.get(message.channel.id, reference.message_id)
+        if cached is not None:
+            return cached
+        try:
+            return await message.channel.fetch_message(reference.message_id)
+        except Exception as e:
+            print(f"   ⚠️ 無法讀取被回覆的訊息: {e}")
+            return None
 
     async def on_message(self, message):
+        # 記錄處理中的訊息數 (不中斷更新時，舊行程會等這些處理完才結束)
+        self.in_flight += 1
+        try:
+            await self.handle_message(message)
+        finally:
+            self.in_flight -= 1
+
+    async def handle_message(self, message):
+        # 0. 所有訊息 (包含自己的) 都記錄到頻道緩衝，組合對話歷史時不必再呼叫 history()
+        self.message_buffer.add(message)
+
         # 1. 忽略自己的訊息
         if message.author == self.user:
             return
 
+        # 已交接給新行程 (或新行程已就緒) 時不再回應
+        if not self.is_active():
+            return
+
         # 2. 檢查是否被提及 (Tagged)
         # 2. 檢查是否被提及 (Tagged) 或 回覆 (Reply)
         is_triggered = self.user in message.mentions
 
+        # 被回覆的訊息只解析一次，觸發判斷、回覆參照、回覆上下文、圖片辨識共用
+        ref_msg = None
+        if message.reference and message.reference.message_id:
+            ref_msg = await self.resolve_reference(message)
+
         # 若未被直接 mention，檢查是否為對機器人的回覆 (Reply without ping)
-        if not is_triggered and message.reference and message.reference.message_id:
-            try:
-                # 嘗試從 cache 取得
-                ref_msg = message.reference.resolved
-                
-                # 若 cache 無資料，則主動抓取 (僅限同頻道)
-                if ref_msg is None and message.channel.id == message.reference.channel_id:
-                    ref_msg = await message.channel.fetch_message(message.reference.message_id)
-                
-                if ref_msg and ref_msg.author == self.user:
-                    is_triggered = True
-                    print(f"   ↩️ 偵測到回覆 (無 Tag): {message.author} 回覆了機器人")
-            except Exception as e:
-                # 抓取失敗或是跨頻道回覆等情況，忽略即可
-                pass
+        if not is_triggered and ref_msg and ref_msg.author == self.user:
+            is_triggered = True
+            print(f"   ↩️ 偵測到回覆 (無 Tag): {message.author} 回覆了機器人")
 
         if is_triggered:
             # 3.1 檢查是否有特殊執行指令 (部署等) - 收到訊息馬上檢查，不調閱歷史
@@ -230,10 +602,21 @@ class TaggedResponseBot(discord.Client):
             
             if self.settings.get("ENABLE_EXEC_COMMAND", False) and self.settings.get("EXEC_COMMAND_KEYWORD", "") in content_clean:
                 print(f"🚀 偵測到關鍵字 '{self.settings.get('EXEC_COMMAND_KEYWORD')}'，準備執行更新並重啟")
+                if self.update_mode == "handover":
+                    # 不中斷更新：在背景準備新行程，交接前照常回應
+                    if self.handover_task and not self.handover_task.done():
+                        await message.reply("⚙️ 更新已在進行中，請稍候。")
+                        return
+                    await message.reply(f"### ⚙️ 機器人正在背景檢查 OTA 更新，新版本就緒後會自動接手，期間仍可正常使用。\n> -# 🤖 提示：你可以提及我並寫上「`{self.settings.get('EXEC_COMMAND_KEYWORD')}`」來檢查更新並重啟機器人")
+                    self.handover_task = asyncio.create_task(self.handover_update(message))
+                    return
                 try:
                     # 使用 reply 告知使用者，然後直接執行
                     await message.reply(f"### ⚙️ 機器人正在檢查 OTA 更新並重新啟動，請稍候。\n如果有可用更新會立即安裝。\n> -# 🤖 提示：你可以提及我並寫上「`{self.settings.get('EXEC_COMMAND_KEYWORD')}`」來檢查更新並重啟機器人")
                     
+                    # 記錄發出指令的頻道，重啟後直接回報 (不必掃描所有頻道)
+                    self.write_update_marker(message)
+
                     # 🚀 重要：先優雅地關閉 Bot 連線，避免 Gateway 噴錯
                     print("🔄 正在關閉 Discord 連線並準備重啟...")
                     await self.close()
@@ -277,16 +660,11 @@ class TaggedResponseBot(discord.Client):
                                     break
                         
                         # Case 2: 如果沒有，檢查是否有回覆，並從回覆中找附件
-                        if not target_image_url and message.reference and message.reference.message_id:
-                            try:
-                                ref_msg_obj = await message.channel.fetch_message(message.reference.message_id)
-                                if ref_msg_obj.attachments:
-                                    for att in ref_msg_obj.attachments:
-                                        if att.content_type and "image" in att.content_type:
-                                            target_image_url = att.url
-                                            break
-                            except Exception as e:
-                                print(f"   ⚠️ 無法讀取回覆的圖片訊息: {e}")
+                        if not target_image_url and ref_msg and ref_msg.attachments:
+                            for att in ref_msg.attachments:
+                                if att.content_type and "image" in att.content_type:
+                                    target_image_url = att.url
+                                    break
 
                         # 若還是沒圖，報錯並結束
                         if not target_image_url:
@@ -299,6 +677,7 @@ class TaggedResponseBot(discord.Client):
                         prompt_text = content_clean.replace("/辨識圖片", "").replace(smarter_keywords, "").strip()
                         if not prompt_text:
                             prompt_text = "請詳細描述這張圖片的內容。" # 預設 Prompt
+                        instruction = prompt_text  # 下方會附加對話歷史，合併相同請求時只比對圖片與指令
 
                         # ------------------------------------------------------------------
                         # 加強: 抓取少量歷史訊息作為參考 (1/3 限額)
@@ -315,7 +694,7 @@ class TaggedResponseBot(discord.Client):
                             hist_lines = []
                             time_fmt = "%H:%M"
                             
-                            async for h_msg in message.channel.history(limit=history_limit):
+                            for h_msg in await self.message_buffer.latest(message.channel, history_limit):
                                 if h_msg.id == message.id: continue # 跳過指令本身
                                 if not h_msg.content.strip(): continue
 
@@ -339,14 +718,14 @@ class TaggedResponseBot(discord.Client):
                             print(f"   ⚠️ 抓取歷史失敗 (不影響圖片辨識): {h_e}")
 
                         # 準備模型
-                        # 如果有 /聰明模型 -> 使用 Smarter List 第一個
-                        # 否則 -> 使用 Normal List 第一個
+                        # 如果有 /聰明模型 -> Smarter List 優先，失敗再回退到 Normal List
+                        # 否則 -> 使用 Normal List
+                        image_model_list = self.model_priority_list
                         if is_smarter_mode:
-                            model_name = self.settings.get("SMARTER_MODEL_PRIORITY_LIST", ["gemini-2.5-flash"])[0]
-                        else:
-                            model_name = self.settings.get("MODEL_PRIORITY_LIST", ["gemini-3.1-flash-lite","gemma-4-31b-it"])[0]
+                            smarter_list = self.settings.get("SMARTER_MODEL_PRIORITY_LIST", ["gemini-2.5-flash"])
+                            image_model_list = smarter_list + [m for m in self.model_priority_list if m not in smarter_list]
 
-                        print(f"   🤖 使用模型辨識: {model_name} (Prompt: {prompt_text})")
+                        print(f"   🤖 使用模型辨識: {image_model_list} (Prompt: {prompt_text})")
                         
                         # 呼叫 GenAI
                         # image_reg.py 參考用法: types.Part.from_uri(file_uri=url, mime_type=...)
@@ -360,15 +739,18 @@ class TaggedResponseBot(discord.Client):
                         
                         contents = [prompt_text, image_part]
                         
-                        response = await self.genai_client.aio.models.generate_content(
-                            model=model_name,
-                            contents=contents,
-                            config=types.GenerateContentConfig(
+                        result = await self.llm.generate(
+                            image_model_list,
+                            contents,
+                            types.GenerateContentConfig(
                                 temperature=0.2 # 圖片辨識稍微精確點
-                            )
+                            ),
+                            label="[圖片] ",
+                            flight_key=[target_image_url, instruction],
                         )
+                        model_name = result.model
                         
-                        if response.text:
+                        if result.ok:
                             if "gemini" in model_name.lower():
                                 footer_model_text = f"> -# 🤖 圖片辨識由 Google Gemini AI 多模態大型語言模型「{model_name}」驅動。\n> -# 💡 使用「`/聰明模型`」以嘗試使用此模型。"
                             else:
@@ -382,8 +764,10 @@ class TaggedResponseBot(discord.Client):
                                 f"> -# 📖 多模態模式回應內容不會參考網路資料。\n"
                                 f"> -# 🖼️ 優先辨識回覆的圖片，若回覆沒有圖片則辨識訊息附件。"
                             )
-                            await message.reply(response.text + footer, allowed_mentions=discord.AllowedMentions.none())
+                            await message.reply(result.text + footer, allowed_mentions=discord.AllowedMentions.none())
                             print("   ✅ 圖片辨識完成並回覆")
+                        elif result.last_error:
+                            raise result.last_error
                         else:
                             await message.reply("🤖 模型看完了圖片，但沒有回傳任何文字描述。")
 
@@ -412,6 +796,8 @@ class TaggedResponseBot(discord.Client):
                         msg_max_length_limit = self.settings.get("SMARTER_MAX_MSG_LENGTH", 5000)
                         print(f"   🧠 Smarter Mode 啟用，提升抓取限制: {total_limit} 則, 長度 {msg_max_length_limit}")
 
+                    time_fmt = build_time_format(self.settings)
+
                     msg_limit = total_limit # 預設全部給最新訊息 (若無回覆)
                     ref_limit = 0
                     
@@ -428,10 +814,9 @@ class TaggedResponseBot(discord.Client):
 
                     # 3.5 檢查是否有回覆參照 (Reply Reference)
                     ref_msg_ctx = ""
-                    if message.reference and message.reference.message_id:
+                    if ref_msg:
                         try:
-                            # 嘗試抓取被回覆的原始訊息
-                            ref_msg = await message.channel.fetch_message(message.reference.message_id)
+                            # 被回覆的原始訊息 (已在上方解析)
                             ref_text = ref_msg.content
                             if len(ref_text) > msg_max_length_limit:
                                 ref_text = ref_text[:msg_max_length_limit] + "..."
@@ -452,155 +837,67 @@ class TaggedResponseBot(discord.Client):
                     # 3.6 抓取回覆參照的「前後文」 (如果有的話)
                     # ref_limit 已經在上方分配完成
                     
-                    # 用於儲存要給 AI 的所有訊息 (msg_id -> (time, formated_text))
+                    # 用於儲存要給 AI 的所有訊息 (msg_id -> (time, formated_text, record))
                     # 使用 dict 是為了稍後去重
                     all_collected_msgs = {} 
                     author_mapping = {} # 記錄作者用戶名與暱稱的對應關係
                     # 務必將當前觸發者加入對照表 (因為 history 迴圈會跳過當前訊息)
                     author_mapping[message.author.id] = (message.author.name, message.author.display_name)
                     
-                    if ref_msg_ctx and message.reference and message.reference.message_id:
-                         try:
-                            # 取得被回覆的訊息物件
-                            center_msg = await message.channel.fetch_message(message.reference.message_id)
-                            
-                            # 抓取該訊息前後 msg_limit 則
-                            async for h_msg in message.channel.history(around=center_msg, limit=ref_limit):
-                                if not h_msg.content.strip() and not h_msg.attachments: continue
-                                
-                                # 記錄作者資訊
-                                author_mapping[h_msg.author.id] = (h_msg.author.name, h_msg.author.display_name)
-
-                                # 格式化 logic 抽取
-                                h_author = h_msg.author.display_name
-                                h_time = h_msg.created_at.astimezone(self.settings.get("TZ")).strftime("%H:%M")
-                                h_author = h_msg.author.display_name
-                                h_time = h_msg.created_at.astimezone(self.settings.get("TZ")).strftime("%H:%M")
-                                h_content = h_msg.content.replace(self.ignore_after_token, "").strip()
-                                
-                                if len(h_content) > msg_max_length_limit:
-                                    h_content = h_content[:msg_max_length_limit] + "..."
-                                
-                                if h_msg.attachments: 
-                                    show_att = self.settings.get("SHOW_ATTACHMENTS", False)
-                                    h_content += " (附件)" if not show_att else f" (附件 {[a.url for a in h_msg.attachments]})"
-
-                                ref_line = f"{h_author}@{h_time}: {h_content}"
-                                all_collected_msgs[h_msg.id] = (h_msg.created_at, ref_line)
-                            
-                            print(f"   📎 讀取回覆上下文: {len(all_collected_msgs)} 則")
-
-                         except Exception as e:
+                    async def fetch_reply_context():
+                        """被回覆訊息的前後文 (失敗不影響主流程)"""
+                        if not ref_msg_ctx:
+                            return []
+                        try:
+                            return await self.message_buffer.around(message.channel, ref_msg, ref_limit)
+                        except Exception as e:
                             print(f"   ⚠️ 無法抓取回覆上下文細節: {e}")
+                            return []
+
+                    # 回覆上下文與最新訊息同時抓取 (兩者互不相依)
+                    around_msgs, latest_msgs = await asyncio.gather(
+                        fetch_reply_context(),
+                        self.message_buffer.latest(message.channel, msg_limit),
+                    )
+
+                    if around_msgs:
+                        # 被回覆訊息前後 ref_limit 則
+                        for h_msg in around_msgs:
+                            record, msg_line = self.line_cache.format(h_msg, self.user.id, self.settings, msg_max_length_limit, time_fmt)
+                            if not record: continue
+                            
+                            # 記錄作者資訊
+                            author_mapping[h_msg.author.id] = (h_msg.author.name, h_msg.author.display_name)
+                            all_collected_msgs[h_msg.id] = (h_msg.created_at, msg_line, record)
+                        
+                        print(f"   📎 讀取回覆上下文: {len(all_collected_msgs)} 則")
 
                     
-                    # 4. 抓取歷史訊息
-                    tz = self.settings.get("TZ", timezone(timedelta(hours=8)))
-
+                    # 4. 整理歷史訊息
                     # 準備變數紀錄「上一句」
                     prev_msg_content = ""
                     found_prev = False
-                    time_fmt = ""
-                    if self.settings.get("SHOW_DATE", False): time_fmt += "%Y年%m月%d日 %A "
-                    time_fmt += "%H:%M"
-                    if self.settings.get("SHOW_SECONDS", False): time_fmt += ":%S"
 
                     # 遍歷歷史訊息
-                    async for msg in message.channel.history(limit=msg_limit):
+                    for msg in latest_msgs:
                         # 跳過指令本身
                         if msg.id == message.id: continue
                         
 
-                        content = msg.content
+                        record, msg_line = self.line_cache.format(msg, self.user.id, self.settings, msg_max_length_limit, time_fmt)
 
-                        # 處理內容截斷與 Bot 名稱判斷
-                        ignore_token = self.ignore_after_token
+                        # 記錄作者資訊 (Bot 訊息以 BOT_NAME 記錄)
                         bot_name = self.settings.get("BOT_NAME", "Bot")
-                        is_bot_msg = False
+                        is_bot_msg = msg.author.id == self.user.id or self.ignore_after_token in msg.content
+                        author_mapping[msg.author.id] = (msg.author.name, bot_name if is_bot_msg else msg.author.display_name)
 
-                        if ignore_token in content:
-                            content = content.split(ignore_token)[0]
-                            is_bot_msg = True
-                        
-                        # 額外檢查：如果是機器人自己發的訊息，一律視為 Bot 訊息
-                        if msg.author.id == self.user.id:
-                            is_bot_msg = True
-                        
-                        # 決定顯示名稱 (用於對照表與訊息)
-                        if is_bot_msg:
-                            display_name = bot_name
-                        else:
-                            display_name = msg.author.display_name
-
-                        # 記錄作者資訊
-                        author_mapping[msg.author.id] = (msg.author.name, display_name)
-                        
-                        # Mentions 處理
-                        if msg.mentions:
-                            for user in msg.mentions:
-                                if user.id == self.user.id:
-                                    u_name_display = bot_name
-                                else:
-                                    u_name_display = user.display_name[:self.settings.get("AUTHOR_NAME_LIMIT", 4)]
-                                content = content.replace(f"<@{user.id}>", f"@{u_name_display}")
-                                content = content.replace(f"<@!{user.id}>", f"@{u_name_display}")
-
-                        # 轉發與附件處理 (Message Snapshots)
-                        if hasattr(msg, 'message_snapshots') and msg.message_snapshots:
-                            for snapshot in msg.message_snapshots:
-                                s_content = getattr(snapshot, 'content', '')
-                                if s_content: content += f"[轉發內容]: {s_content}"
-                                if hasattr(snapshot, 'attachments') and snapshot.attachments:
-                                    content += " (轉發附件)"
-
-                        # 連結簡化
-                        if self.settings.get("SIMPLIFY_LINKS", True):
-                            # Embed 標題替換 - logic kept simplified for brevity
-                             # ... (keep existing link simplification logic if possible or assume it's stable)
-                             # Embed 標題替換
-                            if msg.embeds:
-                                for embed in msg.embeds:
-                                    if embed.title:
-                                        if embed.url and embed.url in content:
-                                            content = content.replace(embed.url, f"(連結 {embed.title})")
-                                        elif content.strip().startswith("http"):
-                                            content = f"(連結 {embed.title})"
-                            
-                            # 剩餘連結僅留網域
-                            def domain_replacer(match):
-                                url = match.group(0)
-                                try:
-                                    no_proto = url.split("://", 1)[1]
-                                    return f"(連結 {no_proto.split('/', 1)[0]})"
-                                except: return url
-                            content = re.sub(r'https?://\S+', domain_replacer, content)
-
-
-                        # 表情與時間
-                        content = re.sub(r'<a?:\w+:\d+>', '(貼圖)', content)
-                        created_at_local = msg.created_at.astimezone(tz).strftime(time_fmt)
-                        
-                        # 長度截斷
-                        if len(content) > msg_max_length_limit:
-                            content = content[:msg_max_length_limit] + "..."
-
-                        # 決定最終顯示名稱 (一般用戶需截斷，Bot 不需)
-                        if is_bot_msg:
-                            author_name = display_name
-                        else:
-                            author_name = display_name[:self.settings.get("AUTHOR_NAME_LIMIT", 4)]
+                        if not record: continue
 
-                        if not content.strip() and not msg.attachments: continue
-
-                        msg_line = f"{author_name}@{created_at_local}: {content}"
-
-                        # 附件顯示
-                        if msg.attachments:
-                            show_att = self.settings.get("SHOW_ATTACHMENTS", False)
-                            msg_line += " (附件)" if not show_att else f" (附件 {[a.url for a in msg.attachments]})"
+                        author_name = transcript_name(record, self.settings)
+                        content = record["content"]
 
                         # 存入 dict，若 id 重複則會覆蓋 (達到去重效果，雖然內容應該一樣)
-                        all_collected_msgs[msg.id] = (msg.created_at, msg_line)
+                        all_collected_msgs[msg.id] = (msg.created_at, msg_line, record)
 
                         # 抓取「上一句」：也就是歷史訊息中第一則(最新的)非 User 本人的有效訊息
                         # 這裡邏輯簡化：只要是第一則有效訊息，就是「上一句」
@@ -630,12 +927,12 @@ class TaggedResponseBot(discord.Client):
                         mapping_section = "\n[用戶與伺服器暱稱對照]\n" + "\n".join(mapping_lines) + "\n"
                         full_context_str = mapping_section + "\n" + full_context_str
 
-                    print(f"   📄 總共收集到 {len(sorted_lines)} 則訊息 (已去重)")
+                    print(f"   📄 總共收集到 {len(sorted_lines)} 則訊息 (已去重，逐字稿行快取: {self.line_cache.stats})")
                     # print(f"--- 收集到的訊息內容 ---\n{full_context_str}\n--------------------")
                     print(f"--- 收集到的訊息內容 ---\n{full_context_str}\n--------------------")
 
                     # 5. 呼叫 AI 模型 (嘗試優先順序列表)
-                    if not self.genai_client:
+                    if not self.llm:
                         await message.reply("❌ 無法回應：未設定 GEMINI_API_KEY。")
                         return
 
@@ -656,69 +953,97 @@ class TaggedResponseBot(discord.Client):
                          # 合併清單：聰明模型優先，若失敗則回退到一般模型清單
                          current_model_list = smarter_list + [m for m in self.model_priority_list if m not in smarter_list]
 
-                    reply_content = None
-                    used_model = None
-                    last_error = None
-                    
-                    normal_msg_limit = self.settings.get("TOTAL_MSG_LIMIT", 50)
+                    input_budgets = self.settings.get("MODEL_INPUT_TOKEN_BUDGETS", {})
+                    default_input_budget = self.settings.get("DEFAULT_INPUT_TOKEN_BUDGET", 8000)
+                    # 對照表放在歷史之後 (新用戶加入時不影響前面可快取的部分)
+                    mapping_suffix = "\n" + mapping_section if author_mapping else ""
+                    context_marker = "\x00CONTEXT\x00"
 
-                    for model_name in current_model_list:
-                        # 判斷當前模型是否為聰明模型 (以決定 Token 上限與 Context 大小)
+                    def render(limit_display, iter_think):
+                        return prompt_template.format(
+                            msg_limit=limit_display, 
+                            context_str=context_marker + mapping_suffix, 
+                            u_name=u_name, 
+                            content_clean=content_clean + final_suffix,
+                            think_on_not=iter_think
+                        )
+
+                    def build_prompt(budget, iter_think):
+                        """
+                        依輸入 token 預算組出 Prompt：超出預算時先刪 Bot/附件訊息，再由最舊的開始刪
+                        回傳 (head, lines, tail, stats)，完整 Prompt = head + "\n".join(lines) + tail
+                        head (人設規則) 與 lines (對話歷史) 是可快取的穩定前綴
+                        """
+                        builder = TranscriptBuilder(budget)
+                        builder.add_section("")
+                        for created_at, line, record in final_msgs:
+                            builder.add(record, line)
+                        lines, stats = builder.build(estimate_tokens(render(len(final_msgs), iter_think)))
+                        lines = lines[1:]  # 去掉空白段落標題
+                        head, tail = render(len(lines), iter_think).split(context_marker, 1)
+                        return head, lines, tail, stats
+
+                    async def prepare(model_name):
+                        """依模型決定 Prompt 與生成參數 (聰明模型使用較大的 Token 上限，Context 依各模型輸入預算裁切)"""
+                        # 判斷當前模型是否為聰明模型 (以決定 Token 上限)
                         is_current_smart = (model_name in smarter_list)
                         
                         # 決定參數
                         if is_current_smart:
                             iter_token_limit = self.settings.get("SMARTER_TOKEN_LIMIT", 120000)
                             iter_think = "並請認真思考。"
-                            iter_context_str = full_context_str
-                            iter_limit_display = msg_limit
                         else:
                             # Fallback 或 一般模式
                             iter_token_limit = self.settings.get("DEFAULT_TOKEN_LIMIT", 3000)
                             iter_think = ""
-                            iter_limit_display = normal_msg_limit
-                            
-                            # 若 Context 太長 (因為是用 Smarter Mode 抓的)，需截斷給一般模型
-                            if len(sorted_lines) > normal_msg_limit:
-                                fallback_lines = sorted_lines[-normal_msg_limit:]
-                                if author_mapping:
-                                    iter_context_str = mapping_section + "\n" + "\n".join(fallback_lines) + "\n"
-                                else:
-                                    iter_context_str = "\n".join(fallback_lines)
-                            else:
-                                iter_context_str = full_context_str
 
-                        # 動態生成 Prompt
-                        prompt = prompt_template.format(
-                            msg_limit=iter_limit_display, 
-                            context_str=iter_context_str, 
-                            u_name=u_name, 
-                            content_clean=content_clean + final_suffix,
-                            think_on_not=iter_think
+                        # 依此模型的輸入預算裁切 Context (離線估算)
+                        budget = input_budgets.get(model_name, default_input_budget)
+                        head, lines, tail, stats = build_prompt(budget, iter_think)
+                        prompt = head + "\n".join(lines) + tail
+
+                        # 選用：以 API 實際計算 token 數，超出預算則依比例縮小預算重新裁切
+                        if self.settings.get("TOKEN_COUNT_CHECK", 0):
+                            actual = await self.llm.count_tokens(model_name, prompt)
+                            if actual and actual > budget:
+                                print(f"   📏 模型 {model_name} 實際 {actual} tokens 超出預算 {budget}，重新裁切")
+                                head, lines, tail, stats = build_prompt(int(budget * budget / actual * 0.95), iter_think)
+                                prompt = head + "\n".join(lines) + tail
+
+                        # 選用：穩定前綴 (人設 + 對話歷史) 放進 Context Cache，只送出快取之後的內容
+                        # 快取中已滑出視窗的舊訊息也會送進模型，需算進輸入預算；兩種模式的歷史長度不同，各自保留快取
+                        cache_name = None
+                        if self.context_cache:
+                            cache_name, cached, stale = await self.context_cache.acquire(
+                                (message.channel.id, model_name, is_smarter_mode), model_name, [head] + lines,
+                                max_stale_tokens=budget - estimate_tokens(prompt))
+                            if cache_name:
+                                if stale:
+                                    tail = render(len(lines) + stale, iter_think).split(context_marker, 1)[1]
+                                prompt = "\n".join(([head] + lines)[cached:]) + tail
+
+                        print(
+                            f"   🤖 模型 {model_name} 參數 (Max Token: {iter_token_limit}, Context: {stats['kept']}則, "
+                            f"預估輸入 {estimate_tokens(prompt)}/{budget} tokens, 省略 {stats['trimmed']}則)"
+                        )
+                        config = types.GenerateContentConfig(
+                            max_output_tokens=iter_token_limit,
+                            temperature=1,
+                            cached_content=cache_name,
                         )
+                        return prompt, config
 
-                        print(f"   🤖 嘗試使用模型: {model_name} (Max Token: {iter_token_limit}, Context: {iter_limit_display}則)...")
-                        try:
-                            # print(prompt) # 減少 Log 雜訊
-                            response = await self.genai_client.aio.models.generate_content(
-                                model=model_name,
-                                contents=prompt,
-                                config=types.GenerateContentConfig(
-                                    max_output_tokens=iter_token_limit,
-                                    temperature=1 
-                                )
-                            )
-                            
-                            if response.text:
-                                reply_content = response.text
-                                used_model = model_name
-                                print(f"   ✅ 模型 {model_name} 成功回應")
-                                print(f"Gemini 回應詳情:\n{response.model_dump_json(indent=2)}")
-                                break # 成功就跳出迴圈
-                        except Exception as e:
-                            print(f"   ⚠️ 模型 {model_name} 失敗: {e}")
-                            last_error = e
-                            continue # 失敗則嘗試下一個
+                    streamer = None
+                    if self.settings.get("STREAM_MODE", 0):
+                        # 串流模式：收到第一段文字就先回覆，之後定時編輯 (與 Hedging 不併用)
+                        streamer = StreamingReply(message, self.settings.get("STREAM_EDIT_INTERVAL_SECONDS", 1.2))
+                        result = await self.llm.generate_stream(current_model_list, streamer.update, prepare=prepare)
+                    else:
+                        result = await self.llm.generate(
+                            current_model_list, prepare=prepare, hedge=bool(self.settings.get("HEDGE_MODE", 0)))
+                    reply_content = result.text
+                    used_model = result.model
+                    last_error = result.last_error
 
                     # 6. 回覆結果
                     if reply_content and used_model:
@@ -748,8 +1073,14 @@ class TaggedResponseBot(discord.Client):
                             f"> -# 🤓 AI 內容僅供參考，不代表本社群立場，敬請核實。\n"
                             f"> -# 📖 回應內容不會參考附件內容、其他頻道、網路資料、訊息表情。"
                         )
-                        await message.reply(reply_content + footer, allowed_mentions=discord.AllowedMentions.none())
+                        if result.interrupted:
+                            footer = "\n> -# ⚠️ 模型回應途中中斷，以上內容可能不完整。" + footer
+                        if streamer:
+                            await streamer.finish(reply_content, footer)
+                        else:
+                            await message.reply(reply_content + footer, allowed_mentions=discord.AllowedMentions.none())
                         print("   ✅ 已傳送回應")
+                        print(f"   📈 {self.llm.latency_report()}")
                     else:
                         if last_error:
                              # 檢查是否為 429 Resource Exhausted 錯誤
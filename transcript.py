@@ -0,0 +1,245 @@
+# transcript.py
+# 共用的訊息清理 (正規化) 模組：server.py / tagged_reply.py / get_message.py 共用
+# 所有正規表示式預先編譯，連結與貼圖在同一次掃描中替換
+
+import re
+from datetime import datetime
+from functools import lru_cache
+
+# 連結與自訂表情合併成一個 pattern，一次掃描完成 (順序與舊版「先連結、後貼圖」結果一致)
+LINK_OR_EMOJI_RE = re.compile(r'(?P<url>https?://\S+)|(?P<emoji><a?:\w+:\d+>)')
+EMOJI_RE = re.compile(r'<a?:\w+:\d+>')
+URL_RE = re.compile(r'https?://\S+')
+# 用戶 <@id> / <@!id>、身分組 <@&id>、頻道 <#id> 提及，一次掃描完成
+MENTION_RE = re.compile(r'<(@!?|@&|#)(\d+)>')
+
+
+def _link_or_emoji_replacer(match):
+    """連結僅留網域，自訂表情轉為 (貼圖)"""
+    url = match.group("url")
+    if url is None:
+        return "(貼圖)"
+    try:
+        no_proto = url.split("://", 1)[1]
+        return f"(連結 {no_proto.split('/', 1)[0]})"
+    except IndexError:
+        return url
+
+
+def build_time_format(settings):
+    """依 SHOW_DATE / SHOW_SECONDS 組出時間格式"""
+    time_fmt = ""
+    if settings.get("SHOW_DATE", False): time_fmt += "%Y年%m月%d日 %A "
+    time_fmt += "%H:%M"
+    if settings.get("SHOW_SECONDS", False): time_fmt += ":%S"
+    return time_fmt
+
+
+@lru_cache(maxsize=4096)
+def _local_time_str(epoch_seconds, tz, time_fmt):
+    return datetime.fromtimestamp(epoch_seconds, tz).strftime(time_fmt)
+
+
+def format_time(created_at, tz, time_fmt):
+    """時間格式化 (同一分鐘內的訊息共用快取結果，省去逐則 strftime)"""
+    epoch_seconds = int(created_at.timestamp())
+    if "%S" not in time_fmt:
+        epoch_seconds -= epoch_seconds % 60
+    return _local_time_str(epoch_seconds, tz, time_fmt)
+
+
+def rewrite_mentions(content, msg, bot_user_id=None, bot_name="Bot", name_limit=None):
+    """
+    以單次正規表示式掃描替換所有提及 (ID -> 顯示名稱查表)
+    用戶與身分組轉為 @名稱，頻道轉為 #名稱；查不到的 ID 維持原樣
+    name_limit: 用戶名稱截斷長度 (None 為不截斷)
+    """
+    if "<" not in content:
+        return content
+
+    users = {}
+    for user in msg.mentions:
+        users[user.id] = bot_name if user.id == bot_user_id else user.display_name[:name_limit]
+    roles = {role.id: role.name for role in getattr(msg, 'role_mentions', None) or ()}
+    channels = {ch.id: ch.name for ch in getattr(msg, 'channel_mentions', None) or ()}
+    if not (users or roles or channels):
+        return content
+
+    def replacer(match):
+        kind, target_id = match.group(1), int(match.group(2))
+        if kind == "#":
+            name = channels.get(target_id)
+            return f"#{name}" if name is not None else match.group(0)
+        name = (roles if kind == "@&" else users).get(target_id)
+        return f"@{name}" if name is not None else match.group(0)
+
+    return MENTION_RE.sub(replacer, content)
+
+
+# normalize_message 的結果取決於這些設定 (本地訊息庫以此判斷已存的紀錄是否仍適用)
+NORMALIZE_SETTING_KEYS = ("IGNORE_TOKEN", "BOT_NAME", "AUTHOR_NAME_LIMIT", "MAX_MSG_LENGTH", "SIMPLIFY_LINKS")
+
+
+def normalize_message(msg, bot_user_id, settings, max_length=None, keep_empty=False):
+    """
+    將 Discord 訊息清理成精簡紀錄 (dict)，內容與附件皆為空則回傳 None
+    max_length: 單則訊息最大長度，未指定則使用 settings["MAX_MSG_LENGTH"]
+    keep_empty: 內容與附件皆為空時仍回傳紀錄 (供作者對照表使用)
+    """
+    content = msg.content
+    ignore_token = settings.get("IGNORE_TOKEN", "-# 🤖")
+    bot_name = settings.get("BOT_NAME", "Bot")
+    name_limit = settings.get("AUTHOR_NAME_LIMIT", 4)
+    if max_length is None:
+        max_length = settings.get("MAX_MSG_LENGTH", 500)
+
+    # 截斷標記
+    is_bot_msg = False
+    if ignore_token and ignore_token in content:
+        content = content.split(ignore_token, 1)[0]
+        is_bot_msg = True
+
+    # 額外檢查：如果是機器人自己發的訊息，一律視為 Bot 訊息
+    if msg.author.id == bot_user_id:
+        is_bot_msg = True
+
+    # Mentions 處理 (用戶 / 身分組 / 頻道)
+    content = rewrite_mentions(content, msg, bot_user_id, bot_name, name_limit)
+
+    # 轉發與附件處理 (Message Snapshots)
+    snapshots = getattr(msg, 'message_snapshots', None)
+    if snapshots:
+        for snapshot in snapshots:
+            s_content = getattr(snapshot, 'content', '')
+            if s_content: content += f"[轉發內容]: {s_content}"
+            if getattr(snapshot, 'attachments', None):
+                content += " (轉發附件)"
+
+    if settings.get("SIMPLIFY_LINKS", True):
+        # Embed 標題替換
+        if msg.embeds:
+            for embed in msg.embeds:
+                if embed.title:
+                    if embed.url and embed.url in content:
+                        content = content.replace(embed.url, f"(連結 {embed.title})")
+                    elif content.strip().startswith("http"):
+                        content = f"(連結 {embed.title})"
+        # 剩餘連結僅留網域 + 表情 (同一次掃描；純文字訊息直接略過正規表示式)
+        if "http" in content or "<" in content:
+            content = LINK_OR_EMOJI_RE.sub(_link_or_emoji_replacer, content)
+    elif "<" in content:
+        content = EMOJI_RE.sub("(貼圖)", content)
+
+    # 長度截斷
+    if len(content) > max_length:
+        content = content[:max_length] + "..."
+
+    if not content.strip() and not msg.attachments and not keep_empty:
+        return None
+
+    return {
+        "id": msg.id,
+        "channel_id": msg.channel.id,
+        "created_at": msg.created_at,
+        "author_id": msg.author.id,
+        "author_name": msg.author.name,
+        # 對照表應始終儲存真實暱稱，以便辨識
+        "display_name": msg.author.display_name,
+        "is_bot": is_bot_msg,
+        "content": content,
+        "attachments": [a.url for a in msg.attachments] if msg.attachments else [],
+    }
+
+
+def transcript_name(record, settings):
+    """逐字稿中的顯示名稱 (一般用戶需截斷，Bot 使用 BOT_NAME 不截斷)"""
+    if record["is_bot"]:
+        return settings.get("BOT_NAME", "Bot")
+    return record["display_name"][:settings.get("AUTHOR_NAME_LIMIT", 4)]
+
+
+def format_line(record, settings, time_fmt):
+    """將訊息紀錄格式化為一行逐字稿：名稱@時間: 內容"""
+    created_at_local = format_time(record["created_at"], settings["TZ"], time_fmt)
+    msg_line = f"{transcript_name(record, settings)}@{created_at_local}: {record['content']}"
+
+    # 附件顯示
+    if record["attachments"]:
+        show_att = settings.get("SHOW_ATTACHMENTS", False)
+        msg_line += " (附件)" if not show_att else f" (附件 {record['attachments']})"
+    return msg_line
+
+
+# 中日韓文字 (含全形符號) 大約 1 字 1 token，其餘文字約 4 字元 1 token
+_CJK_RE = re.compile(r'[\u1100-\u11ff\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef\U00020000-\U0002fa1f]')
+
+
+def estimate_tokens(text):
+    """離線估算 token 數 (CJK-aware，不需呼叫 API，略為高估以保留餘裕)"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4 + 1
+
+
+class TranscriptBuilder:
+    """
+    依 token 預算組裝逐字稿：逐則加入時即累計 token 估計值，
+    超出預算時優先刪除低價值訊息 (Bot 訊息、只有附件的訊息)，再由最舊的訊息開始刪
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.sections = []  # [(header, [entry, ...]), ...]
+        self.total_tokens = 0
+
+    def add_section(self, header):
+        self.sections.append((header, []))
+        self.total_tokens += estimate_tokens(header)
+
+    def add(self, record, line):
+        tokens = estimate_tokens(line)
+        low_value = record["is_bot"] or not record["content"].strip()
+        # entry: [可保留?, 排序鍵 (低價值優先、舊訊息優先), tokens, line]
+        self.sections[-1][1].append([True, (not low_value, record["id"]), tokens, line])
+        self.total_tokens += tokens
+
+    def split_sections(self):
+        """每個段落 (頻道) 拆成獨立的 builder (沿用同一份預算)，供分頻道處理"""
+        builders = []
+        for header, lines in self.sections:
+            builder = TranscriptBuilder(self.budget)
+            builder.sections.append((header, [[True] + e[1:] for e in lines]))
+            builder.total_tokens = estimate_tokens(header) + sum(e[2] for e in lines)
+            builders.append(builder)
+        return builders
+
+    def build(self, reserved_tokens=0):
+        """
+        回傳 (逐字稿 list, stats)
+        reserved_tokens: 逐字稿以外已佔用的 token (prompt 模板、對照表等)
+        stats: {"kept", "trimmed", "tokens", "trimmed_tokens"}
+        """
+        limit = self.budget - reserved_tokens
+        tokens = self.total_tokens
+        trimmed = trimmed_tokens = 0
+
+        if tokens > limit:
+            entries = sorted((e for _, lines in self.sections for e in lines), key=lambda e: e[1])
+            for entry in entries:
+                if tokens <= limit:
+                    break
+                entry[0] = False
+                tokens -= entry[2]
+                trimmed += 1
+                trimmed_tokens += entry[2]
+
+        output = []
+        kept = 0
+        for header, lines in self.sections:
+            kept_lines = [e[3] for e in lines if e[0]]
+            if kept_lines:
+                output.append(header)
+                output.extend(kept_lines)
+                kept += len(kept_lines)
+        return output, {"kept": kept, "trimmed": trimmed, "tokens": tokens, "trimmed_tokens": trimmed_tokens}